@@ -3,30 +3,64 @@ import time
 import sqlite3
 import json
 import zipfile
+import tarfile
 import tempfile
 import shutil
 import glob
 import sys
 import subprocess
+import click
+import mimetypes
 from datetime import datetime
 from flask import (
     Flask,
+    Response,
     jsonify,
     request,
     send_file,
     redirect,
     send_from_directory,
     abort,
+    g,
 )
 from flask_cors import CORS, cross_origin
-from werkzeug.utils import secure_filename
+from werkzeug.utils import secure_filename, safe_join
+from werkzeug.wsgi import wrap_file
+from werkzeug.middleware.proxy_fix import ProxyFix
 from flask import render_template  # only for admin pages
 import helpers
+import helpers.uploads
+import helpers.blobs
+import helpers.catalog
+import helpers.jobs
+import helpers.usage
+import helpers.outbox
+import helpers.results
+import helpers.profiling
+import helpers.ratelimit
+import helpers.tiering
+import helpers.storage
+import helpers.manifests
 
 STATUS_SUBMITTED = 0
 STATUS_QUEUED = 1
 STATUS_COMPLETED = 2
 STATUS_FAILED = 3
+STATUS_NAMES = ["submitted", "queued", "completed", "failed"]
+MAX_QUEUE_WAIT = 60  # seconds a backend can long-poll /experiments/queue
+# seconds a claim lasts when the backend doesn't pass lease, generous so slow
+# backends that never renew keep their experiments, but a crashed one's return
+# to the queue eventually
+DEFAULT_LEASE = int(os.environ.get("DEFAULT_LEASE", "86400"))
+EVENTS_POLL_INTERVAL = 15  # seconds between checks for changes made by other workers
+MAX_FILE_SIZE = 1073741824  # 1GB in bytes
+USERS_PAGE_SIZE = 50  # users per page of /users/list and /admin/users
+# proxies in front of the app that set X-Forwarded-For, e.g. 1 for a load
+# balancer, so the rate limits see each client's address instead of the proxy's
+TRUSTED_PROXIES = int(os.environ.get("TRUSTED_PROXIES", "0"))
+# Each entry in migrations is applied once, in order, and the database's
+# user_version records how many have run. Append new migrations to the end
+# rather than editing ones that have shipped.
 schema = """
 CREATE TABLE IF NOT EXISTS users (id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL, email TEXT UNIQUE, password TEXT, token TEXT unique, token_created TIMESTAMP DEFAULT CURRENT_TIMESTAMP, approved BOOLEAN DEFAULT 0);
 CREATE TABLE IF NOT EXISTS user_settings (uid INTEGER, name TEXT, value TEXT, UNIQUE(uid, name) ON CONFLICT REPLACE, PRIMARY KEY(uid, name));
@@ -38,22 +72,266 @@ CREATE TABLE IF NOT EXISTS files (id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
 -- eid = experiment ID, fid = file ID
 CREATE TABLE IF NOT EXISTS experiment_files (eid INTEGER, fid INTEGER, UNIQUE(eid, fid), PRIMARY KEY(eid, fid), FOREIGN KEY(eid) REFERENCES experiments(id), FOREIGN KEY(fid) REFERENCES files(id));
 CREATE TABLE IF NOT EXISTS limits (id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL, gid INTEGER, name TEXT, value TEXT, UNIQUE(gid, name) ON CONFLICT REPLACE, FOREIGN KEY(gid) REFERENCES groups(id));
+-- resumable chunked uploads, received = bytes written so far
+CREATE TABLE IF NOT EXISTS uploads (id TEXT PRIMARY KEY NOT NULL, uid INTEGER, filename TEXT, size INTEGER, received INTEGER DEFAULT 0, sha256 TEXT, created TIMESTAMP DEFAULT CURRENT_TIMESTAMP, FOREIGN KEY(uid) REFERENCES users(id));
 """
+indexes = """
+CREATE INDEX IF NOT EXISTS idx_experiments_uid ON experiments (uid);
+CREATE INDEX IF NOT EXISTS idx_experiments_status_created ON experiments (status, created);
+CREATE INDEX IF NOT EXISTS idx_experiments_created ON experiments (created);
+CREATE INDEX IF NOT EXISTS idx_experiment_files_fid ON experiment_files (fid);
+CREATE INDEX IF NOT EXISTS idx_files_path ON files (path);
+"""
+# experiments.seq is bumped from a global sequence whenever an experiment
+# changes, so clients can ask for what changed since the last seq they saw
+change_sequence = """
+ALTER TABLE experiments ADD COLUMN seq INTEGER DEFAULT 0;
+UPDATE experiments SET seq = id;
+CREATE INDEX IF NOT EXISTS idx_experiments_seq ON experiments (seq);
+CREATE INDEX IF NOT EXISTS idx_experiments_uid_seq ON experiments (uid, seq);
+"""
+# a backend claims queued experiments under a lease token, and ones whose
+# lease_expires has passed go back to the queue (NULL never expires)
+leases = """
+ALTER TABLE experiments ADD COLUMN lease TEXT;
+ALTER TABLE experiments ADD COLUMN lease_expires TIMESTAMP;
+CREATE INDEX IF NOT EXISTS idx_experiments_lease ON experiments (lease);
+CREATE INDEX IF NOT EXISTS idx_experiments_status_lease_expires ON experiments (status, lease_expires);
+"""
+# inputs are stored once per distinct content, see helpers/blobs.py, and
+# files.hash is cleared once a file no longer holds a reference to its blob
+content_store = """
+ALTER TABLE files ADD COLUMN hash TEXT;
+ALTER TABLE files ADD COLUMN size INTEGER;
+CREATE TABLE IF NOT EXISTS blobs (hash TEXT PRIMARY KEY NOT NULL, size INTEGER, refs INTEGER DEFAULT 0);
+CREATE INDEX IF NOT EXISTS idx_files_hash ON files (hash);
+"""
+# every file uploaded as an experiment's output, see helpers/catalog.py
+output_catalog = """
+CREATE TABLE IF NOT EXISTS outputs (id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL, eid INTEGER, path TEXT UNIQUE, size INTEGER, mtime REAL, FOREIGN KEY(eid) REFERENCES experiments(id));
+CREATE INDEX IF NOT EXISTS idx_outputs_eid ON outputs (eid);
+CREATE INDEX IF NOT EXISTS idx_outputs_mtime ON outputs (mtime);
+"""
+# progress of work done on helpers.jobs' worker pool, bytes = bytes freed
+background_jobs = """
+CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY NOT NULL, kind TEXT, total INTEGER, done INTEGER DEFAULT 0, bytes INTEGER DEFAULT 0, errors INTEGER DEFAULT 0, created TIMESTAMP DEFAULT CURRENT_TIMESTAMP, finished TIMESTAMP);
+"""
+# lets jobs whose process died be told apart from ones still running
+job_heartbeats = """
+ALTER TABLE jobs ADD COLUMN updated TIMESTAMP;
+ALTER TABLE jobs ADD COLUMN failed INTEGER DEFAULT 0;
+"""
+# the files and bytes of each user's inputs, see helpers.usage
+user_usage = """
+CREATE TABLE IF NOT EXISTS usage (uid INTEGER PRIMARY KEY NOT NULL, files INTEGER DEFAULT 0, bytes INTEGER DEFAULT 0);
+INSERT OR REPLACE INTO usage (uid, files, bytes) SELECT experiments.uid, COUNT(*), COALESCE(SUM(files.size), 0) FROM files JOIN experiment_files ON experiment_files.fid = files.id JOIN experiments ON experiments.id = experiment_files.eid GROUP BY experiments.uid;
+"""
+# notifications waiting to be delivered by helpers.outbox
+notification_outbox = """
+CREATE TABLE IF NOT EXISTS outbox (id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL, channel TEXT, destination TEXT, subject TEXT DEFAULT '', message TEXT, attempts INTEGER DEFAULT 0, error TEXT, next_attempt TIMESTAMP DEFAULT CURRENT_TIMESTAMP, lease TEXT, lease_expires TIMESTAMP, created TIMESTAMP DEFAULT CURRENT_TIMESTAMP);
+CREATE INDEX IF NOT EXISTS idx_outbox_next_attempt ON outbox (next_attempt);
+CREATE INDEX IF NOT EXISTS idx_outbox_lease ON outbox (lease);
+"""
+# experiments claimed without a lease before DEFAULT_LEASE existed
+default_leases = """
+UPDATE experiments SET lease_expires = datetime('now', '+1 day') WHERE status = 1 AND lease_expires IS NULL;
+"""
+# outputs uploaded before the catalog existed are cataloged by this job, see
+# helpers.catalog.backfill
+output_backfill = """
+INSERT OR IGNORE INTO jobs (id, kind, total) VALUES ('backfill-outputs', 'backfill', 0);
+"""
+migrations = [
+    schema,
+    indexes,
+    change_sequence,
+    leases,
+    content_store,
+    output_catalog,
+    background_jobs,
+    user_usage,
+    notification_outbox,
+    default_leases,
+    job_heartbeats,
+    output_backfill,
+]
 insert_user = "INSERT INTO users (email, password, token) VALUES (?, ?, ?)"
 insert_settings = "INSERT INTO user_settings (uid, name, value) VALUES (?, ?, ?)"
-insert_experiment = "INSERT INTO experiments (uid, label, host) VALUES (?, ?, ?)"
-insert_file = "INSERT INTO files (path) VALUES (?)"
+next_seq = "(SELECT COALESCE(MAX(seq), 0) + 1 FROM experiments)"
+insert_experiment = (
+    "INSERT INTO experiments (uid, label, host, seq) VALUES (?, ?, ?, %s)" % (next_seq,)
+)
+# only the holder of the current lease can finish a leased experiment, unless
+# the caller doesn't say which lease it holds
+update_status = (
+    "UPDATE experiments SET status = :status, lease_expires = NULL, seq = %s WHERE id = :id AND (:lease IS NULL OR lease = :lease)"
+    % (next_seq,)
+)
+select_lease = "SELECT uid, lease FROM experiments WHERE id = ?"
+insert_file = "INSERT INTO files (path, hash, size) VALUES (?, ?, ?)"
 insert_map = "INSERT INTO experiment_files (eid, fid) VALUES (?, ?)"
+insert_upload = "INSERT INTO uploads (id, uid, filename, size) VALUES (?, ?, ?, ?)"
+select_expired_uploads = (
+    "SELECT id, uid FROM uploads WHERE created < datetime('now', ?)"
+)
+# queries on hot paths, `flask check-query-plans` fails if any need a full scan
+# a page of a user's experiments, newest first, optionally filtered by status
+# and app, `before` is the last id of the previous page and `since` the seq
+# returned by an earlier listing
+filter_experiments = "WHERE uid = :uid AND (:since IS NULL OR seq > :since) AND (:status IS NULL OR status = :status) AND (:before IS NULL OR id < :before) AND (:app IS NULL OR EXISTS (SELECT 1 FROM experiment_settings WHERE eid = experiments.id AND name = 'app' AND value = :app)) ORDER BY id DESC LIMIT :limit"
+select_user_experiments = (
+    "SELECT id, label, created, status, seq FROM experiments " + filter_experiments
+)
+select_user_experiment_inputs = (
+    "SELECT experiment_files.eid, files.path FROM experiment_files JOIN files ON files.id = experiment_files.fid WHERE experiment_files.eid IN (SELECT id FROM experiments "
+    + filter_experiments
+    + ") ORDER BY files.id"
+)
+select_user_experiment_settings = (
+    "SELECT eid, name, value FROM experiment_settings WHERE eid IN (SELECT id FROM experiments "
+    + filter_experiments
+    + ")"
+)
+select_user_sync_state = (
+    "SELECT COUNT(*), COALESCE(MAX(seq), 0) FROM experiments WHERE uid = ?"
+)
+select_user_changes = (
+    "SELECT id, status, seq FROM experiments WHERE uid = ? AND seq > ? ORDER BY seq"
+)
+# claims up to :limit submitted experiments, oldest first, plus queued ones
+# whose lease expired, for the backend polling with :lease
+claim_experiments = (
+    "UPDATE experiments SET status = :queued, lease = :lease, lease_expires = CASE WHEN :seconds IS NULL THEN NULL ELSE datetime('now', '+' || :seconds || ' seconds') END, seq = %s WHERE id IN (SELECT id FROM experiments WHERE (status = :submitted OR (status = :queued AND lease_expires < datetime('now'))) AND (:host IS NULL OR host = :host) ORDER BY created LIMIT :limit)"
+    % (next_seq,)
+)
+select_claimed = "SELECT id, uid, host, lease_expires FROM experiments WHERE lease = ?"
+select_claimed_settings = "SELECT eid, name, value FROM experiment_settings WHERE eid IN (SELECT id FROM experiments WHERE lease = ?)"
+select_path_usage = "SELECT experiments.uid, COUNT(*), COALESCE(SUM(files.size), 0) FROM files JOIN experiment_files ON experiment_files.fid = files.id JOIN experiments ON experiments.id = experiment_files.eid WHERE files.path = ? GROUP BY experiments.uid"
+select_old_inputs = "SELECT path, size FROM files WHERE id IN (SELECT fid FROM experiment_files WHERE eid IN (SELECT id FROM experiments WHERE created < DATE('now', ?)))"
+delete_file_maps = (
+    "DELETE FROM experiment_files WHERE fid IN (SELECT id FROM files WHERE path = ?)"
+)
+delete_files = "DELETE FROM files WHERE path = ?"
+select_old_outputs = "SELECT path, size FROM outputs WHERE mtime < ?"
+# the output itself or everything under it when path is a folder
+delete_outputs = "DELETE FROM outputs WHERE path = :path OR (path >= :path || '/' AND path < :path || '0')"
+select_path_blobs = "SELECT hash FROM files WHERE path = ? AND hash IS NOT NULL"
+select_experiment_blobs = "SELECT id, hash FROM files WHERE hash IS NOT NULL AND id IN (SELECT fid FROM experiment_files WHERE eid = ?)"
+# a page of users, newest first, optionally only those whose email contains
+# `q` or with the given approval state, `before` is the last id of the previous
+# page
+filter_users = "WHERE id < COALESCE(:before, 9223372036854775807) AND (:q IS NULL OR instr(lower(email), lower(:q)) > 0) AND (:approved IS NULL OR approved = :approved) ORDER BY id DESC LIMIT :limit"
+select_users = (
+    "SELECT id, email, token, approved, (SELECT GROUP_CONCAT(gid) FROM user_groups WHERE uid = users.id) FROM users "
+    + filter_users
+)
+select_users_settings = (
+    "SELECT uid, name, value FROM user_settings WHERE uid IN (SELECT id FROM users "
+    + filter_users
+    + ")"
+)
+hot_queries = [
+    select_user_sync_state,
+    select_user_changes,
+    select_user_experiments,
+    select_user_experiment_inputs,
+    select_user_experiment_settings,
+    select_users,
+    select_users_settings,
+    claim_experiments,
+    select_claimed,
+    select_claimed_settings,
+    helpers.usage.select_usage,
+    helpers.usage.select_limits,
+    select_path_usage,
+    select_old_inputs,
+    delete_file_maps,
+    delete_files,
+    select_old_outputs,
+    delete_outputs,
+    select_path_blobs,
+    select_experiment_blobs,
+    helpers.outbox.claim_messages,
+    helpers.outbox.select_claimed,
+]
 
 
 def create_app(test_config=None):
     __version__ = "0.0.1"
-    conn = sqlite3.connect("db.sqlite")
-    db = conn.cursor()
-    db.executescript(schema)
+    conn, db = helpers.create_conn()
+    helpers.migrate(conn, migrations)
+    # jobs left unfinished by a worker that has since exited
+    helpers.jobs.abandon(db)
+    backfill = helpers.catalog.claim_backfill(db)
     conn.commit()
     conn.close()
+    if backfill:
+        helpers.catalog.backfill()
+    helpers.outbox.start()
     app = Flask(__name__, instance_relative_config=True)
+    app.teardown_appcontext(helpers.teardown_conn)
+    # let Apache / lighttpd send result files, see static_file for nginx
+    app.config["USE_X_SENDFILE"] = bool(os.environ.get("USE_X_SENDFILE"))
+    if TRUSTED_PROXIES:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXIES)
+
+    @app.before_request
+    def start_timer():
+        g.request_start = time.perf_counter()
+
+    @app.after_request
+    def record_request(response):
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        helpers.metrics.observe(
+            "ipp_http_request_duration_seconds",
+            {"route": route, "method": request.method, "status": response.status_code},
+            time.perf_counter() - g.request_start,
+        )
+        if request.content_length:
+            helpers.metrics.inc(
+                "ipp_http_request_bytes_total", {"route": route}, request.content_length
+            )
+        if response.content_length is not None:
+            helpers.metrics.inc(
+                "ipp_http_response_bytes_total",
+                {"route": route},
+                response.content_length,
+            )
+        elif response.is_streamed:
+            response.response = helpers.metrics.counted(
+                response.response, "ipp_http_response_bytes_total", {"route": route}
+            )
+        return response
+
+    @app.before_request
+    def start_profile():
+        route = request.url_rule.rule if request.url_rule else None
+        if (
+            request.headers.get("X-Profile") and helpers.is_local(request)
+        ) or helpers.profiling.wanted(route):
+            g.profiler = helpers.profiling.start()
+
+    @app.after_request
+    def finish_profile(response):
+        profiler = g.pop("profiler", None)
+        if profiler is not None:
+            response.headers["X-Profile"] = helpers.profiling.finish(
+                profiler,
+                request,
+                response.status_code,
+                time.perf_counter() - g.request_start,
+            )
+        return response
+
+    @app.teardown_request
+    def abandon_profile(exception=None):
+        # after_request doesn't run when a route raises
+        profiler = g.pop("profiler", None)
+        if profiler is not None:
+            helpers.profiling.finish(
+                profiler, request, 500, time.perf_counter() - g.request_start
+            )
+
     CORS(app)
     app.config["CORS_HEADERS"] = "no-cors"
     prefix = "/api"
@@ -62,11 +340,15 @@ def create_app(test_config=None):
 
     @app.route(f"{prefix}/notifications/notify", methods=["POST", "OPTIONS"])
     def notify():
-        if request.remote_addr != "127.0.0.1":
+        if not helpers.is_local(request):
             abort(403)
         conn, db = helpers.create_conn()
         email = request.form.get("email")
-        uid = db.execute("SELECT id FROM users WHERE email = ?", (email,)).fetchone()[0]
+        user = db.execute("SELECT id FROM users WHERE email = ?", (email,)).fetchone()
+        if user is None:
+            conn.close()
+            return jsonify({"error": "no such user"})
+        uid = user[0]
         rows = db.execute(
             "SELECT value FROM user_settings WHERE uid = ? AND name = 'notification_type'",
             (uid,),
@@ -81,19 +363,34 @@ def create_app(test_config=None):
                     (uid,),
                 ).fetchone()[0]
             )
-            helpers.getattr("send_" + notification_type)(
-                to, request.form.get("message")
-            )
+            if notification_type in helpers.outbox.CHANNELS:
+                helpers.outbox.enqueue(
+                    db, notification_type, to, request.form.get("message")
+                )
+        conn.commit()
         conn.close()
+        helpers.outbox.wake()
+        return jsonify(True)
+
+    def too_many_attempts(wait):
+        response = jsonify({"error": "too many attempts, try again later"})
+        response.headers["Retry-After"] = str(int(wait) + 1)
+        # Retry-After is only honoured on a 429
+        return response, 429
 
     @app.route(f"{prefix}/users/new", methods=["POST", "OPTIONS"])
     @cross_origin()
     def create_user():
         if request.form.get("password") != request.form.get("confirm-password"):
             return jsonify({"error": "passwords don't match"})
-        conn, db = helpers.create_conn()
         email = request.form.get("email")
+        wait = helpers.ratelimit.limited("signup", request.remote_addr, email)
+        if wait:
+            return too_many_attempts(wait)
         password = helpers.get_hashed_password(request.form.get("password"))
+        if password is None:
+            return jsonify({"error": "the server is busy, try again"})
+        conn, db = helpers.create_conn()
         token = helpers.get_token()
         db.execute(insert_user, (email, password, token))
         uid = db.lastrowid
@@ -103,9 +400,10 @@ def create_app(test_config=None):
         db.execute(insert_settings, (uid, "notification_type", "email"))
         # slack messages need to be configured
         # db.execute(insert_settings, (uid, "notification_type", "slack_message"))
-        helpers.notify_admin(request, uid)
+        helpers.notify_admin(db, request, uid)
         conn.commit()
         conn.close()
+        helpers.outbox.wake()
         # return jsonify({"token": token})
         return jsonify(True)
 
@@ -113,12 +411,10 @@ def create_app(test_config=None):
     @cross_origin()
     def set_settings():
         conn, db = helpers.create_conn()
-        if not helpers.is_authd(db, request.form):
+        uid = helpers.authd_uid(db, request.form)
+        if uid is None:
             conn.close()
             return jsonify({"error": "must be logged in"})
-        uid = db.execute(
-            "SELECT id FROM users WHERE token = ?", (request.form.get("token"),)
-        ).fetchone()[0]
         db.execute(
             "INSERT OR REPLACE INTO user_settings (uid, name, value) VALUES (?, ?, ?)",
             (uid, request.form.get("name"), request.form.get("value")),
@@ -127,59 +423,85 @@ def create_app(test_config=None):
         conn.close()
         return jsonify(True)
 
-    @app.route(f"{prefix}/users/list", methods=["GET", "OPTIONS"])
-    def list_users():
-        if request.remote_addr != "127.0.0.1":
-            abort(403)
-        conn, db = helpers.create_conn()
-        rows = db.execute(
-            "SELECT id, email, token, approved FROM users ORDER BY id DESC"
-            if not request.args.get('awaiting_approval') == "1" else
-            "SELECT id, email, token, approved FROM users WHERE approved = 0 ORDER BY id DESC"
-        ).fetchall()
-        users = []
-        for row in rows:
-            settings = db.execute(
-                "SELECT name, value FROM user_settings WHERE uid = ?", (row[0],)
-            ).fetchall()
-            user = {
+    def user_filters(args):
+        # `approved` is 0 or 1, awaiting_approval=1 is the same as approved=0
+        approved = args.get("approved", type=int)
+        if args.get("awaiting_approval") == "1":
+            approved = 0
+        limit = args.get("limit", USERS_PAGE_SIZE, type=int)
+        return {
+            "before": args.get("cursor", type=int),
+            "q": args.get("q") or None,
+            "approved": approved,
+            "limit": limit if limit > 0 else USERS_PAGE_SIZE,
+        }
+
+    def user_page(db, filters):
+        # returns the page's users and the cursor of the next page, or None
+        rows = db.execute(select_users, filters).fetchall()
+        users = [
+            {
                 "id": row[0],
                 "email": row[1],
                 "token": row[2],
                 "approved": row[3],
+                "groups": [int(gid) for gid in row[4].split(",")] if row[4] else [],
                 "settings": {},
             }
-            for setting in settings:
-                user["settings"][setting[0]] = setting[1]
-            users.append(user)
+            for row in rows
+        ]
+        next = rows[-1][0] if len(rows) == filters["limit"] else None
+        return users, next
+
+    @app.route(f"{prefix}/users/list", methods=["GET", "OPTIONS"])
+    def list_users():
+        if not helpers.is_local(request):
+            abort(403)
+        conn, db = helpers.create_conn()
+        filters = user_filters(request.args)
+        users, next = user_page(db, filters)
+        by_id = {user["id"]: user for user in users}
+        for uid, name, value in db.execute(select_users_settings, filters).fetchall():
+            by_id[uid]["settings"][name] = value
         conn.close()
-        return jsonify(users)
+        return jsonify({"users": users, "next": next})
 
     @app.route(f"{prefix}/users/approve/<id>", methods=["GET", "OPTIONS"])
     def approve_user(id):
-        if request.remote_addr != "127.0.0.1":
+        if not helpers.is_local(request):
             abort(403)
         conn, db = helpers.create_conn()
         db.execute("UPDATE USERS SET approved = 1 WHERE id = ?", (id,))
         conn.commit()
         conn.close()
+        helpers.invalidate_user_tokens(id)
         return jsonify(True)
 
     @app.route(f"{prefix}/users/deny/<id>", methods=["GET", "OPTIONS"])
     def deny_user(id):
-        if request.remote_addr != "127.0.0.1":
+        if not helpers.is_local(request):
             abort(403)
         conn, db = helpers.create_conn()
         db.execute("UPDATE USERS SET approved = 0 WHERE id = ?", (id,))
         conn.commit()
         conn.close()
+        helpers.invalidate_user_tokens(id)
         return jsonify(True)
 
     @app.route(f"{prefix}/users/auth", methods=["POST", "OPTIONS"])
     @cross_origin()
     def auth_user():
+        wait = helpers.ratelimit.limited(
+            "auth", request.remote_addr, request.form.get("email")
+        )
+        if wait:
+            return too_many_attempts(wait)
         conn, db = helpers.create_conn()
-        if helpers.login(db, request.form):
+        authenticated = helpers.login(db, request.form)
+        if authenticated is None:
+            conn.close()
+            return jsonify({"token": None, "error": "the server is busy, try again"})
+        if authenticated:
             token = helpers.get_token()
             db.execute(
                 "UPDATE users SET token = ?, token_created = date('now') WHERE email = ?",
@@ -188,84 +510,318 @@ def create_app(test_config=None):
                     request.form.get("email"),
                 ),
             )
+            uid = db.execute(
+                "SELECT id FROM users WHERE email = ?", (request.form.get("email"),)
+            ).fetchone()[0]
             conn.commit()
             conn.close()
+            # the previous token is no longer valid
+            helpers.invalidate_user_tokens(uid)
             return jsonify({"token": token})
         conn.close()
         return jsonify({"token": None, "error": "invalid credentials"})
 
+    @app.route(f"{prefix}/metrics", methods=["GET"])
+    def metrics():
+        if not helpers.is_local(request):
+            return abort(403)
+        conn, db = helpers.create_conn()
+        queue_depth = db.execute(
+            "SELECT status, COUNT(*) FROM experiments GROUP BY status"
+        ).fetchall()
+        outbox_depth = db.execute(
+            "SELECT next_attempt IS NOT NULL, COUNT(*) FROM outbox GROUP BY 1"
+        ).fetchall()
+        conn.close()
+        cache = helpers.token_cache_info()
+        gauges = [
+            (
+                "ipp_experiments",
+                "gauge",
+                "Experiments by status",
+                [
+                    ({"status": STATUS_NAMES[status]}, count)
+                    for status, count in queue_depth
+                ],
+            ),
+            (
+                "ipp_outbox_messages",
+                "gauge",
+                "Notifications waiting in the outbox, or given up on",
+                [
+                    ({"state": "pending" if pending else "failed"}, count)
+                    for pending, count in outbox_depth
+                ],
+            ),
+            (
+                "ipp_token_cache_requests_total",
+                "counter",
+                "Token lookups answered by the cache or the database",
+                [
+                    ({"result": "hit"}, cache["hits"]),
+                    ({"result": "miss"}, cache["misses"]),
+                ],
+            ),
+            (
+                "ipp_token_cache_entries",
+                "gauge",
+                "Tokens in the cache",
+                [({}, cache["size"])],
+            ),
+        ]
+        return Response(
+            helpers.metrics.render(gauges), mimetype="text/plain; version=0.0.4"
+        )
+
+    # POST a `route` (e.g. /api/experiments, or * for every route) and
+    # `seconds` to profile its requests for that long, GET to list profiles
+    @app.route(f"{prefix}/profiles", methods=["GET", "POST"])
+    def profiles():
+        if not helpers.is_local(request):
+            return abort(403)
+        if request.method == "POST":
+            route = request.form.get("route")
+            seconds = request.form.get("seconds", 60, type=int)
+            if not route:
+                return jsonify({"error": "must specify route"})
+            return jsonify({"armed": helpers.profiling.arm(route, seconds)})
+        return jsonify(
+            {
+                "armed": helpers.profiling.armed(),
+                "profiles": helpers.profiling.profiles(),
+            }
+        )
+
+    @app.route(f"{prefix}/profiles/<name>", methods=["GET"])
+    def download_profile(name):
+        if not helpers.is_local(request):
+            return abort(403)
+        return send_from_directory(
+            os.path.abspath(helpers.profiling.PROFILE_DIR), name, as_attachment=True
+        )
+
+    @app.route(f"{prefix}/users/auth/cache", methods=["GET", "OPTIONS"])
+    def auth_cache_stats():
+        if not helpers.is_local(request):
+            abort(403)
+        return jsonify(helpers.token_cache_info())
+
     @app.route(f"{prefix}/experiments", methods=["GET", "OPTIONS"])
     @cross_origin()
     def experiments():
         conn, db = helpers.create_conn()
-        if not helpers.is_authd(db, request.args):
+        uid = helpers.authd_uid(db, request.args)
+        if uid is None:
             conn.close()
             return jsonify({"error": "must be logged in"})
-        uid = db.execute(
-            "SELECT id FROM users WHERE token = ?", (request.args.get("token"),)
-        ).fetchone()[0]
+        limit = request.args.get("limit", type=int)
+        status = request.args.get("status")
+        since = request.args.get("since", type=int)
+        count, seq = db.execute(select_user_sync_state, (uid,)).fetchone()
+        etag = None
+        if since is None:
+            # the listing only changes when one of the user's experiments does
+            etag = helpers.listing_etag(uid, count, seq, request.args)
+            if request.if_none_match.contains(etag):
+                conn.close()
+                response = Response(status=304)
+                response.set_etag(etag)
+                return response
+        filters = {
+            "uid": uid,
+            "since": since,
+            "status": STATUS_NAMES.index(status) if status in STATUS_NAMES else None,
+            "before": request.args.get("cursor", type=int),
+            "app": request.args.get("app"),
+            "limit": limit if limit is not None and limit > 0 else -1,
+        }
+        # inputs and settings for the whole page come from one query each
+        inputs = {}
+        for eid, path in db.execute(select_user_experiment_inputs, filters):
+            inputs.setdefault(eid, []).append(path)
+        settings = {}
+        for eid, name, value in db.execute(select_user_experiment_settings, filters):
+            settings.setdefault(eid, []).append((name, value))
         res = []
-        rows = db.execute(
-            "SELECT id, label, created, status FROM experiments WHERE uid = ?", (uid,)
-        ).fetchall()
+        rows = db.execute(select_user_experiments, filters).fetchall()
+        completed_folder = os.path.join(
+            os.environ["UPLOAD_FOLDER"], str(uid), "completed"
+        )
+        # the outputs of every completed experiment on the page at once
+        outputs = helpers.manifests.listing(
+            completed_folder, {r[0]: r[4] for r in rows if r[3] == STATUS_COMPLETED}
+        )
         for r in rows:
-            output_files = os.listdir(
-                os.path.join(
-                    os.environ["UPLOAD_FOLDER"], str(uid), "completed", str(r[0])
-                )
-            )
-            input_files = db.execute(
-                "SELECT path FROM files WHERE id IN (SELECT fid FROM experiment_files WHERE eid = ?)",
-                (r[0],),
-            ).fetchall()
-            # status_code = 0 if len(output_files) == 0 else 1
             eid = r[0]
-            user_folder = os.path.join(os.environ["UPLOAD_FOLDER"], str(uid))
-            params = db.execute(
-                "SELECT name, value FROM experiment_settings WHERE eid = ?", (eid,)
-            ).fetchall()
             app, experimentDescription, experimentName, params = helpers.extract_params(
-                params, False
+                settings.get(eid, []), False
             )
             res.append(
                 {
-                    "id": r[0],
+                    "id": eid,
                     "label": r[1],
                     "created": r[2],
-                    # "status_code": status_code,
-                    "status": ["submitted", "queued", "completed"][r[3]],
+                    "status": STATUS_NAMES[r[3]],
                     "app": app,
                     "experimentDescription": experimentDescription,
                     "experimentName": experimentName,
-                    "inputs": [item for sublist in input_files for item in sublist],
-                    # list(map(lambda x: os.path.basename(x[0]), input_files))
-                    "outputs": output_files,
+                    "inputs": inputs.get(eid, []),
+                    "outputs": outputs.get(eid, []),
                     "params": params,
                 }
             )
         conn.close()
-        return jsonify({"experiments": res})
+        # pass since back to get only the experiments that changed after this
+        listing = {"experiments": res, "since": seq}
+        if limit is not None and limit > 0:
+            # pass next as cursor to get the following page, None on the last one
+            listing["next"] = rows[-1][0] if len(rows) == limit else None
+        response = jsonify(listing)
+        if etag is not None:
+            response.set_etag(etag)
+        return response
+
+    def forget_path(db, path):
+        # removes everything the database knows about path, returns the blobs
+        # that are no longer referenced so they can be removed after committing
+        eid = helpers.experiment_of(path)
+        if eid is not None:
+            # the experiment's inputs or outputs change
+            db.execute(
+                "UPDATE experiments SET seq = %s WHERE id = ?" % (next_seq,), (eid,)
+            )
+        orphans = [
+            helpers.blobs.release(db, row[0])
+            for row in db.execute(select_path_blobs, (path,)).fetchall()
+        ]
+        for uid, files, size in db.execute(select_path_usage, (path,)).fetchall():
+            helpers.usage.add(db, uid, -files, -size)
+        db.execute(delete_file_maps, (path,))
+        db.execute(delete_files, (path,))
+        db.execute(delete_outputs, {"path": path})
+        return [orphan for orphan in orphans if orphan is not None]
+
+    def forget_outputs(paths):
+        # drops removed outputs from their manifests, each rewritten once in a
+        # short transaction of its own. The seq bump makes other workers drop
+        # what they cached of the manifest while the files were being removed
+        for folder, names in helpers.manifests.by_experiment(paths).items():
+            conn, db = helpers.create_conn()
+            db.execute(
+                "UPDATE experiments SET seq = %s WHERE id = ?" % (next_seq,),
+                (helpers.experiment_of(folder),),
+            )
+            helpers.manifests.forget(folder, names)
+            # nothing left of the experiment's outputs but the manifest
+            store = helpers.storage.backend()
+            if all(name.startswith(".") for name in store.list(folder)):
+                store.delete(folder)
+            conn.commit()
+            conn.close()
+        helpers.notify_changes()
+
+    def experiment_event_stream(token, uid, since):
+        yield "retry: 5000\n\n"
+        while True:
+            version = helpers.changes_version()
+            # not bound to a request any more, so this is a pooled connection
+            conn, db = helpers.create_conn()
+            if helpers.authd_uid(db, {"token": token}) != uid:
+                conn.close()
+                yield "event: logout\ndata: {}\n\n"
+                return
+            rows = db.execute(select_user_changes, (uid, since)).fetchall()
+            conn.close()
+            for eid, status, seq in rows:
+                event = {"id": eid, "status": STATUS_NAMES[status], "outputs": []}
+                if status == STATUS_COMPLETED:
+                    event["outputs"] = helpers.manifests.names(
+                        os.path.join(
+                            os.environ["UPLOAD_FOLDER"],
+                            str(uid),
+                            "completed",
+                            str(eid),
+                        ),
+                        seq,
+                    )
+                yield "id: %d\nevent: experiment\ndata: %s\n\n" % (
+                    seq,
+                    json.dumps(event),
+                )
+                since = seq
+            if not rows:
+                # comments keep proxies from timing out an idle stream
+                yield ": keepalive\n\n"
+            helpers.wait_for_changes(version, EVENTS_POLL_INTERVAL)
+
+    # Server-sent events for the caller's experiments: an `experiment` event
+    # with the id, status and output files each time one changes. Reconnecting
+    # with Last-Event-ID (or ?since=) replays what was missed.
+    @app.route(f"{prefix}/experiments/events", methods=["GET", "OPTIONS"])
+    @cross_origin()
+    def experiment_events():
+        conn, db = helpers.create_conn()
+        uid = helpers.authd_uid(db, request.args)
+        if uid is None:
+            conn.close()
+            return jsonify({"error": "must be logged in"})
+        since = request.headers.get("Last-Event-ID", type=int)
+        if since is None:
+            since = request.args.get("since", type=int)
+        if since is None:
+            since = db.execute(select_user_sync_state, (uid,)).fetchone()[1]
+        conn.close()
+        return Response(
+            experiment_event_stream(request.args.get("token"), uid, since),
+            mimetype="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
 
     @app.route(f"{prefix}/experiments/queue", methods=["GET", "OPTIONS"])
     def experiment_queue():
-        if request.remote_addr != "127.0.0.1":
+        if not helpers.is_local(request):
             abort(403)
+        limit = request.args.get("limit", type=int)
+        seconds = request.args.get("lease", type=int)
+        # with wait, block until something is submitted rather than returning
+        # an empty list right away
+        wait = min(max(request.args.get("wait", 0, type=int), 0), MAX_QUEUE_WAIT)
+        deadline = time.monotonic() + wait
+        lease = helpers.get_token()
         conn, db = helpers.create_conn()
+        while True:
+            state = helpers.queue_state()
+            # claiming is a single UPDATE, so concurrent pollers never get the
+            # same experiment and anything submitted meanwhile waits for the next
+            db.execute(
+                claim_experiments,
+                {
+                    "queued": STATUS_QUEUED,
+                    "submitted": STATUS_SUBMITTED,
+                    "lease": lease,
+                    "seconds": (
+                        seconds
+                        if seconds is not None and seconds > 0
+                        else DEFAULT_LEASE
+                    ),
+                    "host": request.args.get("host"),
+                    "limit": limit if limit is not None and limit > 0 else -1,
+                },
+            )
+            if db.rowcount > 0 or time.monotonic() >= deadline:
+                break
+            conn.commit()
+            helpers.wait_for_job(state, deadline - time.monotonic())
+        settings = {}
+        for eid, name, value in db.execute(select_claimed_settings, (lease,)):
+            settings.setdefault(eid, []).append((name, value))
         experiments = []
-        rows = db.execute(
-            "SELECT id, uid, host FROM experiments WHERE status = ? ORDER BY created DESC",
-            (STATUS_SUBMITTED,),
-        ).fetchall()
+        rows = db.execute(select_claimed, (lease,)).fetchall()
         for r in rows:
             eid = r[0]
             uid = r[1]
-            # or does this happen when backend actually starts job?
-            # db.execute("UPDATE experiments SET queued = 1 WHERE id = ?", (eid,))
-            params = db.execute(
-                "SELECT name, value FROM experiment_settings WHERE eid = ?", (eid,)
-            ).fetchall()
             app, experimentDescription, experimentName, params = helpers.extract_params(
-                params, True
+                settings.get(eid, []), True
             )
             experiments.append(
                 {
@@ -280,24 +836,44 @@ def create_app(test_config=None):
                     "app": app,
                     "experimentDescription": experimentDescription,
                     "experimentName": experimentName,
+                    "lease": lease,
+                    "lease_expires": r[3],
                 }
             )
+        conn.commit()
+        conn.close()
+        if experiments:
+            helpers.notify_changes()
+        return jsonify(experiments)
+
+    # extends the lease on a claimed experiment by `seconds`, returns an error
+    # if it expired and was handed to another backend
+    @app.route(f"{prefix}/experiments/<id>/lease", methods=["POST", "OPTIONS"])
+    def renew_lease(id):
+        if not helpers.is_local(request):
+            abort(403)
+        if request.method == "OPTIONS":
+            return jsonify({"error": "the only request method is POST"})
+        seconds = request.form.get("seconds", type=int)
+        if seconds is None or seconds <= 0:
+            return jsonify({"error": "must specify seconds"})
+        conn, db = helpers.create_conn()
         db.execute(
-            "UPDATE experiments SET status = ? WHERE status = ?",
-            (
-                STATUS_QUEUED,
-                STATUS_SUBMITTED,
-            ),
+            "UPDATE experiments SET lease_expires = datetime('now', '+' || ? || ' seconds') WHERE id = ? AND lease = ? AND status = ?",
+            (seconds, id, request.form.get("lease"), STATUS_QUEUED),
         )
+        renewed = db.rowcount == 1
         conn.commit()
         conn.close()
-        return jsonify(experiments)
+        if not renewed:
+            return jsonify({"error": "lease lost"})
+        return jsonify(True)
 
     @app.route(f"{prefix}/experiments/<id>/files", methods=["GET", "OPTIONS"])
     # https://stackoverflow.com/a/24613980
     # https://stackoverflow.com/a/27337047
     def download_files(id):
-        if request.remote_addr != "127.0.0.1":
+        if not helpers.is_local(request):
             abort(403)
         conn, db = helpers.create_conn()
         uid = db.execute("SELECT uid FROM experiments WHERE id = ?", (id,)).fetchone()[
@@ -306,7 +882,6 @@ def create_app(test_config=None):
         files = os.path.join(
             os.environ["UPLOAD_FOLDER"], str(uid), "submitted", str(id)
         )
-        memory_file = helpers.zipdir(files)
         # @after_this_request
         # def remove_file(response):
         #     try:
@@ -315,47 +890,249 @@ def create_app(test_config=None):
         #         app.logger.error("Error removing or closing downloaded file handle", error)
         #     return response
         conn.close()
-        return send_file(
-            memory_file, attachment_filename="files.zip", as_attachment=True
+        # stream the archive as it's built instead of buffering it in memory
+        return Response(
+            helpers.zipstream(files),
+            mimetype="application/zip",
+            headers={"Content-Disposition": "attachment; filename=files.zip"},
         )
 
     @app.route(f"{prefix}/experiments/<id>/results", methods=["POST", "OPTIONS"])
     def upload_results(id):
-        if request.remote_addr != "127.0.0.1":
+        if not helpers.is_local(request):
             abort(403)
         conn, db = helpers.create_conn()
-        uid = db.execute("SELECT uid FROM experiments WHERE id = ?", (id,)).fetchone()[
-            0
-        ]
+        uid, lease = db.execute(select_lease, (id,)).fetchone()
+        # with a raw tar or zip body the lease is passed in the query string
+        if request.values.get("lease") not in (None, lease):
+            conn.close()
+            return jsonify({"error": "lease lost"})
+        user_folder = os.path.join(os.environ["UPLOAD_FOLDER"], str(uid))
+        completed_job_folder = os.path.join(user_folder, "completed", str(id))
+        # the files are written and verified before taking the write lock
+        stage = helpers.results.staging_folder(completed_job_folder)
+        try:
+            received, manifest = helpers.results.receive(request, stage)
+            error = helpers.results.verify(received, manifest)
+        except (tarfile.TarError, zipfile.BadZipFile, EOFError):
+            error = "The results archive is not a valid tar or zip file"
+        if error is not None:
+            shutil.rmtree(stage, ignore_errors=True)
+            conn.close()
+            return jsonify({"error": error})
+        # saved to the store before taking the write lock, which on S3 would
+        # otherwise be held while they upload, and only moved into the
+        # experiment's folder once the update below has won the lease
+        versions = helpers.results.upload(stage, received)
         db.execute(
-            "UPDATE experiments SET status = ? WHERE id = ?", (STATUS_COMPLETED, id)
+            update_status,
+            {
+                "status": STATUS_COMPLETED,
+                "id": id,
+                "lease": request.values.get("lease"),
+            },
         )
+        if db.rowcount != 1:
+            conn.rollback()
+            conn.close()
+            helpers.results.discard(stage)
+            return jsonify({"error": "lease lost"})
+        published = {}
+        for dest in helpers.results.publish(stage, completed_job_folder, received):
+            helpers.tiering.discard_stale(db, dest)
+            name = os.path.basename(dest)
+            helpers.catalog.record(db, id, dest, versions[name])
+            published[name] = (versions[name][0], received[name])
+        # written before committing, while no one else can change the folder
+        helpers.manifests.add(completed_job_folder, published)
         conn.commit()
         conn.close()
-        user_folder = os.path.join(os.environ["UPLOAD_FOLDER"], str(uid))
-        completed_job_folder = os.path.join(user_folder, "completed", str(id))
-        for file in request.files.values():
-            secure_fn = secure_filename(file.filename)
-            dest = os.path.join(completed_job_folder, secure_fn)
-            file.save(dest)
+        helpers.notify_changes()
         return jsonify(True)
 
     @app.route(f"{prefix}/experiments/<id>/file", methods=["GET", "OPTIONS"])
     @cross_origin()
     def static_file(id):
         conn, db = helpers.create_conn()
-        if not helpers.is_authd(db, request.args):
+        uid = helpers.authd_uid(db, request.args)
+        if uid is None:
             conn.close()
             return jsonify({"error": "must be logged in"})
-        uid = db.execute(
-            "SELECT id FROM users WHERE token = ?", (request.args.get("token"),)
-        ).fetchone()[0]
         conn.close()
-        path = request.args.get("path")
-        return send_from_directory(
-            os.path.join(os.environ["UPLOAD_FOLDER"], str(uid), "completed", id), path
+        folder = os.path.join(os.environ["UPLOAD_FOLDER"], str(uid), "completed", id)
+        path = safe_join(folder, request.args.get("path", ""))
+        if path is None:
+            return abort(404)
+        store = helpers.storage.backend()
+        if not store.local:
+            return send_stored(store, path)
+        tiered = helpers.tiering.tiered_path(path)
+        if tiered is not None:
+            return send_tiered(path, tiered)
+        if not os.path.isfile(path):
+            return abort(404)
+        # with X_ACCEL_REDIRECT set to an internal nginx location aliased to
+        # UPLOAD_FOLDER, nginx sends the file (and handles ranges) itself
+        if "X_ACCEL_REDIRECT" in os.environ:
+            return helpers.accel_redirect(path)
+        # answers Range, If-Range, If-None-Match and If-Modified-Since
+        return send_file(path, conditional=True, etag=helpers.file_etag(path))
+
+    def send_tiered(path, tiered):
+        # served by the app even with X_ACCEL_REDIRECT, which would lose the
+        # encoding. The gzip and decompressed bodies are different
+        # representations, so they get different ETags, and neither answers
+        # Range (no Accept-Ranges), a range of the compressed bytes would be
+        # no use to a client that wants part of the output
+        mimetype = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        etag = helpers.file_etag(tiered)
+        if "gzip" in request.accept_encodings:
+            response = Response(
+                wrap_file(request.environ, open(tiered, "rb")),
+                mimetype=mimetype,
+                direct_passthrough=True,
+            )
+            response.content_length = os.stat(tiered).st_size
+            response.headers["Content-Encoding"] = "gzip"
+            etag += "-gz"
+        else:
+            response = Response(helpers.tiering.decompressed(tiered), mimetype=mimetype)
+        response.set_etag(etag)
+        response.last_modified = os.stat(tiered).st_mtime
+        response.vary.add("Accept-Encoding")
+        return response.make_conditional(request)
+
+    def send_stored(store, path):
+        # the object is only fetched once the response is sent, and only the
+        # range that's asked for
+        try:
+            size, mtime = store.stat(path)
+        except FileNotFoundError:
+            return abort(404)
+        response = Response(
+            wrap_file(request.environ, store.stream(path)),
+            mimetype=mimetypes.guess_type(path)[0] or "application/octet-stream",
+            direct_passthrough=True,
+        )
+        response.content_length = size
+        response.set_etag("%x-%x" % (size, int(mtime * 1e9)))
+        response.last_modified = mtime
+        return response.make_conditional(
+            request, accept_ranges=True, complete_length=size
         )
 
+    # Large inputs can be sent in chunks ahead of /experiments/new: create an
+    # upload, PUT ranges of it with a `Content-Range: bytes start-end/total`
+    # header, GET it to find the offset to resume from after a dropped
+    # connection, then pass its id as `upload-<input name>` to /experiments/new
+    @app.route(f"{prefix}/uploads/new", methods=["POST", "OPTIONS"])
+    @cross_origin()
+    def new_upload():
+        conn, db = helpers.create_conn()
+        uid = helpers.authd_uid(db, request.form)
+        if uid is None:
+            conn.close()
+            return jsonify({"error": "must be logged in"})
+        filename = request.form.get("filename", "")
+        size = request.form.get("size", type=int)
+        if secure_filename(filename) == "" or size is None or size < 0:
+            conn.close()
+            return jsonify({"error": "must specify filename and size"})
+        if size > MAX_FILE_SIZE:
+            conn.close()
+            return jsonify(
+                {"error": 'The file "%s" exceeds the 1GB file size limit' % (filename,)}
+            )
+        upload_id = helpers.uploads.new_id()
+        db.execute(insert_upload, (upload_id, uid, filename, size))
+        if size == 0:
+            sha256 = helpers.uploads.empty(helpers.uploads.part_path(uid, upload_id))
+            db.execute(
+                "UPDATE uploads SET sha256 = ? WHERE id = ?", (sha256, upload_id)
+            )
+        conn.commit()
+        conn.close()
+        return jsonify({"id": upload_id, "offset": 0})
+
+    @app.route(f"{prefix}/uploads/<id>", methods=["GET", "PUT", "DELETE", "OPTIONS"])
+    @cross_origin()
+    def upload_chunk(id):
+        conn, db = helpers.create_conn()
+        uid = helpers.authd_uid(db, request.args)
+        if uid is None:
+            conn.close()
+            return jsonify({"error": "must be logged in"})
+        upload = db.execute(
+            "SELECT size, received, sha256 FROM uploads WHERE id = ? AND uid = ?",
+            (id, uid),
+        ).fetchone()
+        if upload is None:
+            conn.close()
+            return jsonify({"error": "no such upload"})
+        size, received, sha256 = upload
+        path = helpers.uploads.part_path(uid, id)
+        if request.method == "DELETE":
+            db.execute("DELETE FROM uploads WHERE id = ?", (id,))
+            conn.commit()
+            conn.close()
+            helpers.uploads.discard(path, id)
+            return jsonify(True)
+        if request.method != "PUT":
+            conn.close()
+            return jsonify(
+                {
+                    "offset": received,
+                    "size": size,
+                    "complete": received == size,
+                    "sha256": sha256,
+                }
+            )
+        content_range = helpers.uploads.parse_content_range(
+            request.headers.get("Content-Range")
+        )
+        start = received if content_range is None else content_range[0]
+        if content_range is not None and content_range[2] not in (None, size):
+            conn.close()
+            return jsonify({"error": "upload size doesn't match", "offset": received})
+        if start != received:
+            conn.close()
+            return jsonify(
+                {"error": "expected offset %d" % (received,), "offset": received}
+            )
+        # reject oversized chunks before reading any of the body
+        if start + (request.content_length or 0) > size:
+            conn.close()
+            return jsonify(
+                {"error": "upload exceeds its declared size", "offset": received}
+            )
+        with helpers.uploads.upload_lock(id):
+            error = None
+            try:
+                error = helpers.uploads.write_chunk(
+                    path, id, request.stream, start, size
+                )
+            finally:
+                # record whatever reached the disk, even if the client went away
+                received = helpers.uploads.offset(id, start)
+                db.execute(
+                    "UPDATE uploads SET received = ? WHERE id = ?", (received, id)
+                )
+                conn.commit()
+            if received == size:
+                sha256 = helpers.uploads.checksum(id)
+                db.execute("UPDATE uploads SET sha256 = ? WHERE id = ?", (sha256, id))
+                conn.commit()
+        conn.close()
+        response = {
+            "offset": received,
+            "size": size,
+            "complete": received == size,
+            "sha256": sha256,
+        }
+        if error:
+            response["error"] = error
+        return jsonify(response)
+
     # Uploaded files and the form, serialized as JSON, are placed in
     # a folder like `UPLOAD_FOLDER/uid/submitted/eid` where UPLOAD_FOLDER
     # is an environment variable, uid is a users ID, and eid is an experiment
@@ -367,12 +1144,10 @@ def create_app(test_config=None):
     @cross_origin()
     def new_experiment():
         conn, db = helpers.create_conn()
-        if not helpers.is_authd(db, request.form):
+        uid = helpers.authd_uid(db, request.form)
+        if uid is None:
             conn.close()
             return jsonify({"error": "must be logged in"})
-        uid = db.execute(
-            "SELECT id FROM users WHERE token = ?", (request.form.get("token"),)
-        ).fetchone()[0]
         db.execute(
             insert_experiment,
             (uid, request.form.get("label"), request.form.get("host")),
@@ -382,51 +1157,108 @@ def create_app(test_config=None):
         job_folder = os.path.join(user_folder, "submitted", str(eid))
         completed_job_folder = os.path.join(user_folder, "completed", str(eid))
         edited_job_folder = os.path.join(user_folder, "edited", str(eid))
-        os.makedirs(job_folder, exist_ok=True)
-        os.makedirs(completed_job_folder, exist_ok=True)
-        os.makedirs(edited_job_folder, exist_ok=True)
+        store = helpers.storage.backend()
+        store.makedirs(job_folder)
+        store.makedirs(completed_job_folder)
+        store.makedirs(edited_job_folder)
         request_dict = request.form.to_dict(flat=True)
         del request_dict["token"]
         del request_dict["host"]
         # request_dict["createdAt"] = datetime.now().strftime("%d/%m/%Y %H:%M:%S")
         # request_dict["ownerId"] = uid
         # request_dict["_id"] = eid
-        # each user is allowed 50 files, and no one file can exceed 1G
-        user_files = db.execute(
-            "SELECT COUNT(*) FROM files WHERE id IN (SELECT fid FROM experiment_files WHERE eid IN (SELECT id FROM experiments WHERE uid = ?))",
-            (uid,),
-        ).fetchone()[0]
-        remaining = 50 - user_files
-        if remaining < len(request.files):
+        # each user is allowed the files and bytes in their groups' limits (50
+        # files by default), and no one file can exceed 1G
+        # inputs sent earlier through /uploads are attached as upload-<input name>
+        uploads = {}
+        for key in request.form:
+            if key.startswith("upload-"):
+                del request_dict[key]
+                upload = db.execute(
+                    "SELECT id, filename, size, received, sha256 FROM uploads WHERE id = ? AND uid = ?",
+                    (request.form.get(key), uid),
+                ).fetchone()
+                if upload is None or upload[3] != upload[2] or upload[4] is None:
+                    conn.close()
+                    return jsonify(
+                        {"error": 'The upload for "%s" is not complete' % (key[7:],)}
+                    )
+                uploads[key[7:]] = upload
+        stored = []
+
+        def discard_submission():
+            # before the rollback frees eid for another request to reuse
+            store.delete(job_folder)
+            store.delete(completed_job_folder)
+            store.delete(edited_job_folder)
+            conn.rollback()
+            helpers.blobs.discard_unreferenced(db, stored)
             conn.close()
-            return jsonify(
-                {
-                    "error": "The %d files you tried to upload exceed the %d remaining files you have left in your quota"
-                    % (len(request.files), remaining)
-                }
-            )
+
+        # the size of the uploaded files is only known once they're received
+        error = helpers.usage.check(
+            db,
+            uid,
+            len(request.files) + len(uploads),
+            sum(upload[2] for upload in uploads.values()),
+        )
+        if error is not None:
+            discard_submission()
+            return jsonify({"error": error})
+        total_files = total_bytes = 0
         # for file in request.files.values():
         for input_name, file in request.files.items():
             if file.filename != "":
                 secure_fn = secure_filename(file.filename)
                 dest = os.path.join(job_folder, secure_fn)
-                file.save(dest)
-                # possible to determine file size before writing to disk?
-                if os.path.getsize(dest) > 1073741824:  # 1GB in bytes
-                    shutil.rmtree(job_folder)
-                    shutil.rmtree(completed_job_folder)
-                    shutil.rmtree(edited_job_folder)
-                    conn.close()
+                # hashed while it's written, and given up on once it's too big
+                received = helpers.blobs.receive(file.stream, MAX_FILE_SIZE)
+                if received is None:
+                    discard_submission()
                     return jsonify(
                         {
                             "error": 'The file "%s" exceeds the 1GB file size limit'
                             % (file.filename,)
                         }
                     )
-                db.execute(insert_file, (dest,))
+                tmp, digest, size = received
+                helpers.blobs.store(db, tmp, digest, size, dest)
+                stored.append(digest)
+                total_files += 1
+                total_bytes += size
+                db.execute(insert_file, (dest, digest, size))
                 fid = db.lastrowid
                 db.execute(insert_map, (eid, fid))
                 request_dict[input_name] = dest
+        # checked before any upload is attached, so a rejected submission
+        # leaves them as they were for a retry
+        error = helpers.usage.check(
+            db,
+            uid,
+            total_files + len(uploads),
+            total_bytes + sum(upload[2] for upload in uploads.values()),
+        )
+        if error is not None:
+            discard_submission()
+            return jsonify({"error": error})
+        for input_name, upload in uploads.items():
+            dest = os.path.join(job_folder, secure_filename(upload[1]))
+            # the partial file itself is only removed once this commits
+            helpers.blobs.store(
+                db,
+                helpers.blobs.stage(helpers.uploads.part_path(uid, upload[0])),
+                upload[4],
+                upload[2],
+                dest,
+            )
+            db.execute("DELETE FROM uploads WHERE id = ?", (upload[0],))
+            total_files += 1
+            total_bytes += upload[2]
+            db.execute(insert_file, (dest, upload[4], upload[2]))
+            fid = db.lastrowid
+            db.execute(insert_map, (eid, fid))
+            request_dict[input_name] = dest
+        helpers.usage.add(db, uid, total_files, total_bytes)
         for k, v in request_dict.items():
             db.execute(
                 "INSERT INTO experiment_settings (name, value, eid) VALUES (?, ?, ?)",
@@ -434,11 +1266,17 @@ def create_app(test_config=None):
             )
         conn.commit()
         conn.close()
+        for upload in uploads.values():
+            helpers.uploads.discard(
+                helpers.uploads.part_path(uid, upload[0]), upload[0]
+            )
+        helpers.notify_changes()
+        helpers.notify_job()
         return jsonify(True)
 
     @app.route(f"{prefix}/experiments/<id>/delete", methods=["DELETE", "OPTIONS"])
     def delete_experiment_inputs(id):
-        if request.remote_addr != "127.0.0.1":
+        if not helpers.is_local(request):
             return abort(403)
         if request.method == "OPTIONS":
             return jsonify({"error": "the only request method is DELETE"})
@@ -446,78 +1284,207 @@ def create_app(test_config=None):
         uid = db.execute("SELECT uid FROM experiments WHERE id = ?", (id,)).fetchone()[
             0
         ]
+        # the inputs' rows stay for the listing but stop referencing their blobs
+        orphans = []
+        for fid, digest in db.execute(select_experiment_blobs, (id,)).fetchall():
+            orphans.append(helpers.blobs.release(db, digest))
+            db.execute("UPDATE files SET hash = NULL WHERE id = ?", (fid,))
+        conn.commit()
         conn.close()
-        try:
-            shutil.rmtree(
-                os.path.join(os.environ["UPLOAD_FOLDER"], str(uid), "submitted", id)
-            )
-        except FileNotFoundError:
+        for orphan in orphans:
+            helpers.remove_path(orphan)
+        store = helpers.storage.backend()
+        folder = os.path.join(os.environ["UPLOAD_FOLDER"], str(uid), "submitted", id)
+        if not store.exists(folder):
             return jsonify(False)
+        store.delete(folder)
         return jsonify(True)
 
     @app.route(f"{prefix}/experiments/<id>/failed", methods=["POST", "OPTIONS"])
     def mark_failed(id):
-        if request.remote_addr != "127.0.0.1":
+        if not helpers.is_local(request):
             return abort(403)
         if request.method == "OPTIONS":
             return jsonify({"error": "the only request method is POST"})
         conn, db = helpers.create_conn()
         db.execute(
-            "UPDATE experiments SET status = ? WHERE id = ?", (STATUS_FAILED, id)
+            update_status,
+            {"status": STATUS_FAILED, "id": id, "lease": request.form.get("lease")},
         )
+        if db.rowcount != 1:
+            conn.close()
+            return jsonify({"error": "lease lost"})
         conn.commit()
         conn.close()
+        helpers.notify_changes()
         return jsonify(True)
 
     @app.route(f"{prefix}/files/delete", methods=["POST", "OPTIONS"])
     def delete_file():
-        if request.remote_addr != "127.0.0.1":
+        if not helpers.is_local(request):
             return abort(403)
         if request.method == "OPTIONS":
             return jsonify({"error": "the only request method is POST"})
         conn, db = helpers.create_conn()
         path = request.form.get("path")
-        db.execute(
-            "DELETE FROM experiment_files WHERE eid IN (SELECT id FROM files WHERE path = ?)",
-            (path,),
-        )
-        db.execute("DELETE FROM files WHERE path = ?", (path,))
-        shutil.rmtree(path)
+        orphans = forget_path(db, path)
         conn.commit()
         conn.close()
+        helpers.remove_path(path)
+        for orphan in orphans:
+            helpers.remove_path(orphan)
+        forget_outputs([path])
         return jsonify(True)
 
+    # Deletes a list of paths (a JSON body like {"paths": [...]} or repeated
+    # `path` form fields) or everything /files/old would return for `days`.
+    # The database rows go in one transaction and the files are removed in the
+    # background, poll /jobs/{id} for progress and the bytes freed.
+    @app.route(f"{prefix}/files/delete/batch", methods=["POST", "OPTIONS"])
+    def delete_files_batch():
+        if not helpers.is_local(request):
+            return abort(403)
+        if request.method == "OPTIONS":
+            return jsonify({"error": "the only request method is POST"})
+        conn, db = helpers.create_conn()
+        days = request.form.get("days")
+        if days is not None:
+            if not days.isdigit():
+                conn.close()
+                return jsonify({"error": "days must be a number"})
+            paths = [
+                row[0]
+                for row in db.execute(
+                    select_old_inputs, ("-%d days" % (int(days),),)
+                ).fetchall()
+                + db.execute(
+                    select_old_outputs, (time.time() - int(days) * 86400,)
+                ).fetchall()
+            ]
+        else:
+            body = request.get_json(silent=True) or {}
+            paths = body.get("paths") or request.form.getlist("path")
+            if not isinstance(paths, list) or not all(
+                isinstance(path, str) for path in paths
+            ):
+                conn.close()
+                return jsonify({"error": "paths must be a list of paths"})
+        # never delete anything outside the upload folder
+        upload_folder = os.path.join(os.path.abspath(os.environ["UPLOAD_FOLDER"]), "")
+        paths = [
+            path
+            for path in set(paths)
+            if os.path.abspath(path).startswith(upload_folder)
+        ]
+        orphans = []
+        for path in paths:
+            orphans += forget_path(db, path)
+        # the reaper also sweeps chunked uploads that were never attached
+        expired = []
+        if days is not None:
+            expired = db.execute(
+                select_expired_uploads,
+                ("-%d days" % (helpers.uploads.UPLOAD_TTL_DAYS,),),
+            ).fetchall()
+            db.executemany(
+                "DELETE FROM uploads WHERE id = ?", [(row[0],) for row in expired]
+            )
+        job_id = helpers.jobs.create(db, "delete", len(paths) + len(orphans))
+        conn.commit()
+        conn.close()
+        # partial files are always local, whatever the storage backend
+        for upload_id, uid in expired:
+            helpers.uploads.discard(
+                helpers.uploads.part_path(uid, upload_id), upload_id
+            )
+        helpers.jobs.start(
+            job_id,
+            paths + orphans,
+            helpers.remove_path,
+            then=lambda: forget_outputs(paths),
+        )
+        helpers.notify_changes()
+        return jsonify({"job": job_id, "total": len(paths) + len(orphans)})
+
+    # Compresses outputs older than `days` (TIER_AFTER_DAYS by default) in the
+    # background, poll /jobs/{id} for progress and the bytes reclaimed.
+    @app.route(f"{prefix}/files/tier", methods=["POST", "OPTIONS"])
+    def tier_outputs():
+        if not helpers.is_local(request):
+            return abort(403)
+        if request.method == "OPTIONS":
+            return jsonify({"error": "the only request method is POST"})
+        if not helpers.storage.backend().local:
+            return jsonify({"error": "only outputs stored locally are tiered"})
+        days = request.form.get("days") or str(helpers.tiering.TIER_AFTER_DAYS)
+        if not days.isdigit():
+            return jsonify({"error": "days must be a number"})
+        conn, db = helpers.create_conn()
+        paths = helpers.tiering.candidates(db, time.time() - int(days) * 86400)
+        job_id = helpers.jobs.create(db, "tier", len(paths))
+        conn.commit()
+        conn.close()
+        helpers.jobs.start(job_id, paths, helpers.tiering.tier)
+        return jsonify({"job": job_id, "total": len(paths)})
+
+    @app.route(f"{prefix}/jobs/<id>", methods=["GET", "OPTIONS"])
+    def job_status(id):
+        if not helpers.is_local(request):
+            return abort(403)
+        conn, db = helpers.create_conn()
+        helpers.jobs.abandon(db, id)
+        status = helpers.jobs.status(db, id)
+        conn.commit()
+        conn.close()
+        if status is None:
+            return jsonify({"error": "no such job"})
+        return jsonify(status)
+
     @app.route(f"{prefix}/files/old", methods=["GET", "OPTIONS"])
     def files_older_than():
-        if request.remote_addr != "127.0.0.1":
+        if not helpers.is_local(request):
             return abort(403)
         if request.method == "OPTIONS":
             return jsonify({"error": "the only request method is GET"})
         conn, db = helpers.create_conn()
         days = request.args.get("days")
-        if days is None:
+        if days is None or not days.isdigit():
             return jsonify({"error": "must specify days"})
         old_inputs = db.execute(
-            "SELECT path FROM files WHERE id IN (SELECT fid FROM experiment_files WHERE eid IN (SELECT id FROM experiments WHERE created < DATE('now', '-%s days')))"
-            % (days,)
+            select_old_inputs, ("-%d days" % (int(days),),)
+        ).fetchall()
+        # outputs come from the catalog, see `flask reconcile-outputs`
+        old_outputs = db.execute(
+            select_old_outputs, (time.time() - int(days) * 86400,)
         ).fetchall()
-        old_outputs = []
-        for f in glob.glob(
-            os.path.join(os.environ["UPLOAD_FOLDER"], "*", "completed", "*")
-        ):
-            if os.path.getmtime(f) < time.time() - int(days) * 86400:
-                old_outputs.append(f)
         conn.close()
-        return jsonify(
-            [item for sublist in old_inputs for item in sublist] + old_outputs
+        response = jsonify([row[0] for row in old_inputs + old_outputs])
+        response.headers["X-Total-Bytes"] = str(
+            sum(row[1] or 0 for row in old_inputs + old_outputs)
         )
+        return response
+
+    @app.route(f"{prefix}/users/usage", methods=["GET", "OPTIONS"])
+    @cross_origin()
+    def get_usage():
+        conn, db = helpers.create_conn()
+        uid = helpers.authd_uid(db, request.args)
+        if uid is None:
+            conn.close()
+            return jsonify({"error": "must be logged in"})
+        files, size = helpers.usage.current(db, uid)
+        limits = helpers.usage.limits(db, uid)
+        conn.close()
+        return jsonify({"files": files, "bytes": size, **limits})
 
     @app.route(f"{prefix}/users/groups", methods=["GET", "OPTIONS"])
     @cross_origin()
     def get_groups():
         conn, db = helpers.create_conn()
-        token = request.args.get("token")
-        uid = db.execute("SELECT id FROM users WHERE token = ?", (token,)).fetchone()[0]
+        uid = helpers.authd_uid(db, request.args)
+        if uid is None:
+            conn.close()
+            return jsonify({"error": "must be logged in"})
         groups = db.execute(
             "SELECT name FROM groups WHERE id IN (SELECT gid FROM user_groups WHERE uid = ?)",
             (uid,),
@@ -527,37 +1494,24 @@ def create_app(test_config=None):
 
     @app.route(f"{prefix}/admin/users", methods=["GET", "OPTIONS"])
     def user_admin_panel():
-        if request.remote_addr != "127.0.0.1":
+        if not helpers.is_local(request):
             abort(403)
         conn, db = helpers.create_conn()
-        rows = db.execute(
-            "SELECT id, email, token, approved FROM users ORDER BY id DESC"
-        ).fetchall()
-        users = []
-        for r in rows:
-            user_groups = db.execute(
-                "SELECT gid FROM user_groups WHERE uid = ?", (r[0],)
-            ).fetchall()
-            users.append(
-                {
-                    "id": r[0],
-                    "email": r[1],
-                    "token": r[2],
-                    "approved": r[3],
-                    "groups": [g[0] for g in user_groups],
-                }
-            )
+        filters = user_filters(request.args)
+        users, next = user_page(db, filters)
 
         rows = db.execute("SELECT id, name FROM groups ORDER BY id DESC").fetchall()
         groups = []
         for r in rows:
             groups.append({"id": r[0], "name": r[1]})
         conn.close()
-        return render_template("users.html", users=users, groups=groups)
+        return render_template(
+            "users.html", users=users, groups=groups, filters=filters, next=next
+        )
 
     @app.route(f"{prefix}/admin/groups", methods=["GET", "OPTIONS"])
     def group_admin_panel():
-        if request.remote_addr != "127.0.0.1":
+        if not helpers.is_local(request):
             abort(403)
         conn, db = helpers.create_conn()
         rows = db.execute("SELECT id, name FROM groups ORDER BY id DESC").fetchall()
@@ -569,7 +1523,7 @@ def create_app(test_config=None):
 
     @app.route(f"{prefix}/groups/create", methods=["POST", "OPTIONS"])
     def create_group():
-        if request.remote_addr != "127.0.0.1":
+        if not helpers.is_local(request):
             abort(403)
         conn, db = helpers.create_conn()
         db.execute("INSERT INTO groups (name) VALUES (?)", (request.form.get("group"),))
@@ -579,7 +1533,7 @@ def create_app(test_config=None):
 
     @app.route(f"{prefix}/groups/remove/<id>", methods=["POST", "OPTIONS"])
     def remove_group(id):
-        if request.remote_addr != "127.0.0.1":
+        if not helpers.is_local(request):
             abort(403)
         conn, db = helpers.create_conn()
         db.execute("DELETE FROM groups WHERE id = ?", (id,))
@@ -590,7 +1544,7 @@ def create_app(test_config=None):
 
     @app.route(f"{prefix}/groups/edit/<id>", methods=["POST", "OPTIONS"])
     def edit_group(id):
-        if request.remote_addr != "127.0.0.1":
+        if not helpers.is_local(request):
             abort(403)
         conn, db = helpers.create_conn()
         db.execute(
@@ -606,7 +1560,7 @@ def create_app(test_config=None):
 
     @app.route(f"{prefix}/users/groups/map", methods=["POST", "OPTIONS"])
     def map_user_to_group():
-        if request.remote_addr != "127.0.0.1":
+        if not helpers.is_local(request):
             abort(403)
         conn, db = helpers.create_conn()
         uid = request.form.get("uid")
@@ -622,7 +1576,7 @@ def create_app(test_config=None):
 
     @app.route(f"{prefix}/version/update", methods=["POST", "OPTIONS"])
     def update_version():
-        if request.remote_addr != "127.0.0.1":
+        if not helpers.is_local(request):
             abort(403)
         if 'GIT_DIR' in os.environ:
             to_checkout = request.form.get("checkout")
@@ -640,7 +1594,7 @@ def create_app(test_config=None):
 
     @app.route(f"{prefix}/fe-version/update", methods=["POST", "OPTIONS"])
     def update_frontend_version():
-        if request.remote_addr != "127.0.0.1":
+        if not helpers.is_local(request):
             abort(403)
         if 'GIT_DIR' not in os.environ:
             return jsonify({"error": "GIT_DIR not set"})
@@ -658,6 +1612,37 @@ def create_app(test_config=None):
             sys.exit(0)
         return jsonify({"error": "FE_GIT_DIR not set"})
 
+    @app.cli.command("check-query-plans")
+    def check_query_plans():
+        conn, db = helpers.create_conn()
+        failed = False
+        for query in hot_queries:
+            for scan in helpers.full_scans(db, query):
+                print("%s\n    %s" % (query, scan))
+                failed = True
+        conn.close()
+        sys.exit(1 if failed else 0)
+
+    @app.cli.command("reconcile-outputs")
+    @click.option("--check", is_flag=True, help="Only report differences.")
+    def reconcile_outputs(check):
+        conn, db = helpers.create_conn()
+        missing, stale, changed = helpers.catalog.reconcile(db, fix=not check)
+        conn.commit()
+        conn.close()
+        for label, paths in (
+            ("missing", missing),
+            ("stale", stale),
+            ("changed", changed),
+        ):
+            for path in paths:
+                print("%s %s" % (label, path))
+        print(
+            "%d missing, %d stale, %d changed"
+            % (len(missing), len(stale), len(changed))
+        )
+        sys.exit(1 if check and (missing or stale or changed) else 0)
+
     if __name__ == "__main__":
         port = 8080
         host = "0.0.0.0"
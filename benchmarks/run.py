@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+# Seeds a synthetic database and upload folder, drives the API's routes through
+# the Flask test client and reports throughput, p50/p99 latency and peak RSS,
+# compared against a baseline saved by an earlier run with --save, e.g.
+#
+#   python benchmarks/run.py --save            # on a known-good commit
+#   python benchmarks/run.py                   # exits 1 on a regression
+#
+# Baselines depend on the machine, so only compare runs made on the same one.
+
+import io
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import sqlite3
+import argparse
+import resource
+import tempfile
+import importlib.util
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LOCAL = {"REMOTE_ADDR": "127.0.0.1"}
+STATUSES = [0, 0, 1, 2, 2, 2, 3]  # mostly completed, some submitted / queued
+
+
+def load_app(workdir):
+    # the app opens db.sqlite in the working directory
+    os.chdir(workdir)
+    os.environ["UPLOAD_FOLDER"] = os.path.join(workdir, "uploads")
+    os.makedirs(os.environ["UPLOAD_FOLDER"], exist_ok=True)
+    sys.path.insert(0, ROOT)
+    spec = importlib.util.spec_from_file_location(
+        "ipp", os.path.join(ROOT, "__init__.py"), submodule_search_locations=[ROOT]
+    )
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["ipp"] = module
+    spec.loader.exec_module(module)
+    return module, module.create_app()
+
+
+def seed(module, args):
+    rng = random.Random(args.seed)
+    upload_folder = os.environ["UPLOAD_FOLDER"]
+    db = sqlite3.connect("db.sqlite")
+    db.executemany(
+        "INSERT INTO users (id, email, password, token, approved) VALUES (?, ?, 'x', ?, 1)",
+        [
+            (u, "user%d@example.com" % u, "token%d" % u)
+            for u in range(1, args.users + 1)
+        ],
+    )
+    # lift the default quota so /experiments/new keeps succeeding
+    db.execute("INSERT INTO groups (id, name) VALUES (1, 'benchmark')")
+    db.executemany(
+        "INSERT INTO user_groups (uid, gid) VALUES (?, 1)",
+        [(u,) for u in range(1, args.users + 1)],
+    )
+    db.execute(
+        "INSERT INTO limits (gid, name, value) VALUES (1, 'max_files', '1000000000')"
+    )
+    eid = fid = 0
+    experiments, settings, files, maps, outputs = [], [], [], [], []
+    for u in range(1, args.users + 1):
+        for _ in range(args.experiments):
+            eid += 1
+            status = rng.choice(STATUSES)
+            age = rng.randint(0, 90)
+            experiments.append(
+                (eid, u, "label %d" % eid, "host", status, "-%d days" % age, eid)
+            )
+            settings += [
+                (eid, "setting%d" % s, "value %d" % rng.randint(0, 1000))
+                for s in range(args.settings)
+            ]
+            settings.append((eid, "app", "app%d" % rng.randint(0, 4)))
+            folder = os.path.join(upload_folder, str(u), "submitted", str(eid))
+            os.makedirs(folder, exist_ok=True)
+            fid += 1
+            path = os.path.join(folder, "input.nii")
+            with open(path, "wb") as f:
+                f.write(os.urandom(args.file_size))
+            files.append((fid, path, args.file_size))
+            maps.append((eid, fid))
+            if status != 2:
+                continue
+            folder = os.path.join(upload_folder, str(u), "completed", str(eid))
+            os.makedirs(folder, exist_ok=True)
+            for o in range(args.outputs):
+                path = os.path.join(folder, "output%d.nii" % o)
+                with open(path, "wb") as f:
+                    f.write(os.urandom(args.file_size))
+                outputs.append((eid, path, args.file_size, time.time() - age * 86400))
+    db.executemany(
+        "INSERT INTO experiments (id, uid, label, host, status, created, seq) VALUES (?, ?, ?, ?, ?, datetime('now', ?), ?)",
+        experiments,
+    )
+    db.executemany(
+        "INSERT INTO experiment_settings (eid, name, value) VALUES (?, ?, ?)", settings
+    )
+    db.executemany("INSERT INTO files (id, path, size) VALUES (?, ?, ?)", files)
+    db.executemany("INSERT INTO experiment_files (eid, fid) VALUES (?, ?)", maps)
+    db.executemany(
+        "INSERT INTO outputs (eid, path, size, mtime) VALUES (?, ?, ?, ?)", outputs
+    )
+    db.commit()
+    # the usage migration's backfill counts the seeded inputs
+    db.executescript(module.user_usage)
+    db.close()
+    return eid
+
+
+def scenarios(args, experiments):
+    rng = random.Random(args.seed)
+
+    def token():
+        return "token%d" % rng.randint(1, args.users)
+
+    def list_page(client):
+        return client.get("/api/experiments?limit=50&token=" + token())
+
+    def list_all(client):
+        return client.get("/api/experiments?token=" + token())
+
+    def queue(client):
+        return client.get("/api/experiments/queue?limit=1", environ_base=LOCAL)
+
+    def new(client):
+        return client.post(
+            "/api/experiments/new",
+            data={
+                "token": token(),
+                "label": "benchmark",
+                "host": "host",
+                "app": "app0",
+                "input": (io.BytesIO(os.urandom(args.file_size)), "input.nii"),
+            },
+        )
+
+    def files_old(client):
+        return client.get("/api/files/old?days=30", environ_base=LOCAL)
+
+    def download(client):
+        eid = rng.randint(1, experiments)
+        return client.get("/api/experiments/%d/files" % eid, environ_base=LOCAL)
+
+    return {
+        "experiments": list_page,
+        "experiments-all": list_all,
+        "queue": queue,
+        "new": new,
+        "files-old": files_old,
+        "download": download,
+    }
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def measure(app, request, args):
+    client = app.test_client()
+    for _ in range(args.warmup):
+        request(client).get_data()
+
+    def timed(_):
+        start = time.perf_counter()
+        response = request(client)
+        # streamed responses only finish once they're read
+        body = response.get_data()
+        elapsed = time.perf_counter() - start
+        failed = response.status_code != 200 or body.startswith(b'{"error"')
+        return elapsed, failed
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        results = list(pool.map(timed, range(args.requests)))
+    total = time.perf_counter() - start
+    latencies = [r[0] for r in results]
+    return {
+        "throughput": args.requests / total,
+        "p50": percentile(latencies, 50),
+        "p99": percentile(latencies, 99),
+        "errors": sum(r[1] for r in results),
+    }
+
+
+def compare(results, baseline, tolerance):
+    # returns a description of every metric that's worse than the baseline by
+    # more than tolerance
+    regressions = []
+    for name, result in results["scenarios"].items():
+        base = baseline["scenarios"].get(name)
+        if base is None:
+            continue
+        if result["throughput"] < base["throughput"] * (1 - tolerance):
+            regressions.append(
+                "%s throughput %.1f/s < %.1f/s"
+                % (name, result["throughput"], base["throughput"])
+            )
+        for key in ("p50", "p99"):
+            if result[key] > base[key] * (1 + tolerance):
+                regressions.append(
+                    "%s %s %.2fms > %.2fms"
+                    % (name, key, result[key] * 1000, base[key] * 1000)
+                )
+    if results["peak_rss_kb"] > baseline["peak_rss_kb"] * (1 + tolerance):
+        regressions.append(
+            "peak RSS %dKB > %dKB" % (results["peak_rss_kb"], baseline["peak_rss_kb"])
+        )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the API's routes")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--experiments", type=int, default=40, help="per user")
+    parser.add_argument("--settings", type=int, default=5, help="per experiment")
+    parser.add_argument("--outputs", type=int, default=3, help="per completed one")
+    parser.add_argument("--file-size", type=int, default=4096, help="bytes")
+    parser.add_argument("--requests", type=int, default=200, help="per scenario")
+    parser.add_argument("--warmup", type=int, default=10)
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--only", action="append", help="scenario to run, can be repeated"
+    )
+    parser.add_argument(
+        "--baseline", default=os.path.join(ROOT, "benchmarks", "baseline.json")
+    )
+    parser.add_argument("--save", action="store_true", help="save as the baseline")
+    parser.add_argument(
+        "--tolerance", type=float, default=0.2, help="allowed slowdown, 0.2 = 20%%"
+    )
+    parser.add_argument("--keep", action="store_true", help="keep the seeded data")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="ipp-benchmark-")
+    try:
+        module, app = load_app(workdir)
+        start = time.perf_counter()
+        experiments = seed(module, args)
+        print(
+            "seeded %d users, %d experiments in %.1fs"
+            % (args.users, experiments, time.perf_counter() - start)
+        )
+        scale = {
+            k: getattr(args, k)
+            for k in (
+                "users",
+                "experiments",
+                "settings",
+                "outputs",
+                "file_size",
+                "requests",
+                "concurrency",
+            )
+        }
+        results = {"scale": scale, "scenarios": {}}
+        print(
+            "%-16s %10s %10s %10s %7s"
+            % ("scenario", "req/s", "p50 ms", "p99 ms", "errors")
+        )
+        for name, request in scenarios(args, experiments).items():
+            if args.only and name not in args.only:
+                continue
+            result = measure(app, request, args)
+            results["scenarios"][name] = result
+            print(
+                "%-16s %10.1f %10.2f %10.2f %7d"
+                % (
+                    name,
+                    result["throughput"],
+                    result["p50"] * 1000,
+                    result["p99"] * 1000,
+                    result["errors"],
+                )
+            )
+        # kilobytes on Linux
+        results["peak_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        print("peak RSS %dKB" % (results["peak_rss_kb"],))
+    finally:
+        if args.keep:
+            print("seeded data kept in", workdir)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.save:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print("saved baseline to", args.baseline)
+        return 0
+    if not os.path.exists(args.baseline):
+        print("no baseline at %s, run with --save to create one" % (args.baseline,))
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline["scale"] != results["scale"]:
+        print("the baseline was run at a different scale, not comparing")
+        return 0
+    regressions = compare(results, baseline, args.tolerance)
+    for regression in regressions:
+        print("REGRESSION", regression)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
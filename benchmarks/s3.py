@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+# Drives the routes that save and read stored files with STORAGE_BACKEND=s3 and
+# checks what ends up in the bucket, e.g. against a local MinIO
+#
+#   docker run -p 9000:9000 minio/minio server /data
+#   export S3_ENDPOINT_URL=http://localhost:9000 S3_BUCKET=ipp
+#   export AWS_ACCESS_KEY_ID=minioadmin AWS_SECRET_ACCESS_KEY=minioadmin
+#   python benchmarks/s3.py
+#
+# or with --fake against an in-memory stand-in for boto3, which needs neither.
+# Everything is written under a fresh S3_PREFIX that's removed afterwards.
+
+import io
+import os
+import sys
+import types
+import shutil
+import secrets
+import sqlite3
+import zipfile
+import argparse
+import datetime
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from run import LOCAL, load_app
+
+
+class FakeClientError(Exception):
+    def __init__(self, code):
+        self.response = {"Error": {"Code": code}}
+
+
+class FakeS3:
+    # the calls helpers/storage.py makes, on a dict of key -> (data, metadata,
+    # mtime). There's no download_fileobj, so using it fails here
+    exceptions = types.SimpleNamespace(ClientError=FakeClientError)
+
+    def __init__(self):
+        self.objects = {}
+
+    def _object(self, key):
+        if key not in self.objects:
+            raise FakeClientError("404")
+        return self.objects[key]
+
+    def put_object(self, Bucket, Key, Body, Metadata=None):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        self.objects[Key] = (bytes(Body), dict(Metadata or {}), now)
+
+    def upload_file(self, Filename, Bucket, Key, Config=None):
+        with open(Filename, "rb") as f:
+            self.put_object(Bucket, Key, f.read())
+
+    def copy(self, CopySource, Bucket, Key, Config=None):
+        data, metadata, mtime = self._object(CopySource["Key"])
+        self.put_object(Bucket, Key, data, metadata)
+
+    def head_object(self, Bucket, Key):
+        data, metadata, mtime = self._object(Key)
+        return {"ContentLength": len(data), "Metadata": metadata, "LastModified": mtime}
+
+    def get_object(self, Bucket, Key, Range=None):
+        data = self._object(Key)[0]
+        start = int(Range[len("bytes=") : -1]) if Range else 0
+        return {"Body": io.BytesIO(data[start:])}
+
+    def delete_object(self, Bucket, Key):
+        self.objects.pop(Key, None)
+
+    def delete_objects(self, Bucket, Delete):
+        for o in Delete["Objects"]:
+            self.objects.pop(o["Key"], None)
+
+    def get_paginator(self, name):
+        return self
+
+    def paginate(self, Bucket, Prefix, Delimiter=None, MaxKeys=1000):
+        contents, prefixes = [], []
+        for key in sorted(k for k in self.objects if k.startswith(Prefix)):
+            rest = key[len(Prefix) :]
+            if Delimiter and Delimiter in rest:
+                prefix = Prefix + rest.split(Delimiter)[0] + Delimiter
+                if prefix not in prefixes:
+                    prefixes.append(prefix)
+                continue
+            data, metadata, mtime = self.objects[key]
+            contents.append({"Key": key, "Size": len(data), "LastModified": mtime})
+        contents = contents[:MaxKeys]
+        page = {
+            "KeyCount": len(contents) + len(prefixes),
+            "CommonPrefixes": [{"Prefix": p} for p in prefixes],
+        }
+        if contents:
+            page["Contents"] = contents
+        yield page
+
+
+def install_fake():
+    # registers a boto3 whose clients share one FakeS3
+    fake = FakeS3()
+    boto3 = types.ModuleType("boto3")
+    boto3.session = types.ModuleType("boto3.session")
+    boto3.session.Session = lambda: types.SimpleNamespace(
+        client=lambda name, endpoint_url=None: fake
+    )
+    boto3.s3 = types.ModuleType("boto3.s3")
+    boto3.s3.transfer = types.ModuleType("boto3.s3.transfer")
+    boto3.s3.transfer.TransferConfig = lambda **kwargs: kwargs
+    for module in (boto3, boto3.session, boto3.s3, boto3.s3.transfer):
+        sys.modules[module.__name__] = module
+    os.environ["S3_BUCKET"] = "ipp"
+
+
+def check(failures, name, ok):
+    print("%-40s %s" % (name, "ok" if ok else "FAILED"))
+    if not ok:
+        failures.append(name)
+
+
+def run(module, app):
+    store = module.helpers.storage.backend()
+    upload_folder = os.environ["UPLOAD_FOLDER"]
+    db = sqlite3.connect("db.sqlite")
+    db.execute(
+        "INSERT INTO users (id, email, password, token, approved) VALUES (1, 'a@example.com', 'x', 'token', 1)"
+    )
+    db.commit()
+    db.close()
+    client = app.test_client()
+    failures = []
+
+    content = os.urandom(64 * 1024)
+    response = client.post(
+        "/api/experiments/new",
+        data={
+            "token": "token",
+            "label": "s3",
+            "host": "host",
+            "app": "app",
+            "t1": (io.BytesIO(content), "t1.nii"),
+            "t2": (io.BytesIO(content), "t2.nii"),
+        },
+    )
+    check(failures, "new experiment", response.json is True)
+    inputs = [
+        os.path.join(upload_folder, "1", "submitted", "1", name)
+        for name in ("t1.nii", "t2.nii")
+    ]
+    heads = [
+        store.client.head_object(Bucket=store.bucket, Key=store.key(path))
+        for path in inputs
+    ]
+    check(
+        failures,
+        "inputs refer to one blob",
+        all(h["ContentLength"] == 0 for h in heads)
+        and len({h["Metadata"].get("blob") for h in heads} - {None}) == 1,
+    )
+    check(
+        failures, "inputs stat as their blob", store.stat(inputs[0])[0] == len(content)
+    )
+
+    response = client.get("/api/experiments/1/files", environ_base=LOCAL)
+    archive = zipfile.ZipFile(io.BytesIO(response.get_data()))
+    check(
+        failures,
+        "inputs download",
+        sorted(archive.namelist()) == ["t1.nii", "t2.nii"]
+        and archive.read("t2.nii") == content,
+    )
+
+    lease = client.get("/api/experiments/queue", environ_base=LOCAL).json[0]["lease"]
+    output = os.urandom(256 * 1024)
+    response = client.post(
+        "/api/experiments/1/results",
+        data={"lease": lease, "out": (io.BytesIO(output), "out.nii")},
+        environ_base=LOCAL,
+    )
+    check(failures, "upload results", response.json is True)
+    response = client.get("/api/experiments?token=token")
+    check(
+        failures,
+        "outputs listed",
+        response.json["experiments"][0]["outputs"] == ["out.nii"],
+    )
+
+    url = "/api/experiments/1/file?token=token&path=out.nii"
+    response = client.get(url)
+    check(failures, "output download", response.get_data() == output)
+    etag = response.headers["ETag"]
+    response = client.get(url, headers={"Range": "bytes=1000-1999"})
+    check(
+        failures,
+        "output range",
+        response.status_code == 206 and response.get_data() == output[1000:2000],
+    )
+    response = client.get(url, headers={"If-None-Match": etag})
+    check(failures, "output not modified", response.status_code == 304)
+
+    response = client.delete("/api/experiments/1/delete", environ_base=LOCAL)
+    check(
+        failures,
+        "inputs deleted with their blob",
+        response.json is True
+        and not any(store.exists(path) for path in inputs)
+        and not store.exists(os.path.join(upload_folder, "blobs")),
+    )
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the S3 storage backend")
+    parser.add_argument("--fake", action="store_true", help="use an in-memory S3")
+    args = parser.parse_args()
+
+    if args.fake:
+        install_fake()
+    os.environ["STORAGE_BACKEND"] = "s3"
+    os.environ["S3_PREFIX"] = "ipp-check-%s/" % (secrets.token_hex(4),)
+    # the checks call the local-only routes as 127.0.0.1
+    os.environ.pop("LOCAL_TOKEN", None)
+    os.environ.pop("TRUSTED_PROXIES", None)
+    workdir = tempfile.mkdtemp(prefix="ipp-s3-")
+    try:
+        module, app = load_app(workdir)
+        failures = run(module, app)
+        store = module.helpers.storage.backend()
+        store.delete(os.environ["UPLOAD_FOLDER"])
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
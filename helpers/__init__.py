@@ -1,56 +1,313 @@
 import os
+import time
 import sqlite3
 import bcrypt
 import secrets
 import smtplib
 import requests
 import json
+import queue
+import hashlib
+import threading
+import collections
 import zipfile
-import io
+from concurrent.futures import ProcessPoolExecutor
 from email.mime.text import MIMEText
+import mimetypes
+import urllib.parse
+from flask import g, has_app_context, Response
+from helpers import metrics
+from helpers import storage
 
+# formats that are already compressed are stored as-is in zip archives
+COMPRESSED_EXTENSIONS = (".gz", ".zip", ".bz2", ".xz", ".zst", ".tgz")
+CHUNK_SIZE = 1024 * 1024
 
-def zipdir(path):
-    memory_file = io.BytesIO()
-    with zipfile.ZipFile(memory_file, "w") as zf:
-        for root, dirs, files in os.walk(path):
-            for file in files:
-                zf.write(os.path.join(root, file))
-    memory_file.seek(0)
-    return memory_file
+
+class _ZipStreamBuffer:
+    # write-only file object that zipfile writes into, drained by zipstream
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def zipstream(path):
+    # yields a zip archive of path chunk by chunk so memory use stays constant
+    # and the first bytes go out before the whole archive is built, entry
+    # names are relative to path
+    store = storage.backend()
+    buf = _ZipStreamBuffer()
+    with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as zf:
+        for full_path, size, mtime in store.walk(path):
+            zinfo = zipfile.ZipInfo(
+                os.path.relpath(full_path, path), time.localtime(mtime)[:6]
+            )
+            zinfo.external_attr = 0o644 << 16
+            # decides whether the entry needs zip64
+            zinfo.file_size = size
+            zinfo.compress_type = (
+                zipfile.ZIP_STORED
+                if full_path.lower().endswith(COMPRESSED_EXTENSIONS)
+                else zipfile.ZIP_DEFLATED
+            )
+            with store.open(full_path) as src, zf.open(zinfo, "w") as dest:
+                while True:
+                    chunk = src.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    dest.write(chunk)
+                    data = buf.drain()
+                    if data:
+                        yield data
+            data = buf.drain()
+            if data:
+                yield data
+    yield buf.drain()
+
+
+DB_PATH = "db.sqlite"
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 8))
+DB_BUSY_TIMEOUT = 30  # seconds a writer waits for the lock before failing
+
+
+class PooledConnection(sqlite3.Connection):
+    # routes close() their connection when they're done with it, which hands it
+    # back to the pool, or leaves it for teardown if it belongs to the request
+    def close(self):
+        if has_app_context() and g.get("db_conn") is self:
+            return
+        release_conn(self)
+
+
+_pool = queue.LifoQueue(maxsize=DB_POOL_SIZE)
+_pool_pid = os.getpid()
+
+
+def _connect():
+    conn = sqlite3.connect(
+        DB_PATH,
+        timeout=DB_BUSY_TIMEOUT,
+        factory=PooledConnection,
+        cached_statements=256,
+        check_same_thread=False,
+    )
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute("PRAGMA busy_timeout = %d" % (DB_BUSY_TIMEOUT * 1000,))
+    return conn
+
+
+def _acquire_conn():
+    global _pool, _pool_pid
+    # connections must not be shared with a forked worker
+    if _pool_pid != os.getpid():
+        _pool = queue.LifoQueue(maxsize=DB_POOL_SIZE)
+        _pool_pid = os.getpid()
+    try:
+        conn = _pool.get_nowait()
+    except queue.Empty:
+        conn = _connect()
+    conn.released = False
+    return conn
+
+
+def release_conn(conn):
+    if getattr(conn, "released", False):
+        return
+    conn.released = True
+    # whatever a route didn't commit (e.g. it returned early) is discarded
+    if conn.in_transaction:
+        conn.rollback()
+    if _pool_pid == os.getpid():
+        try:
+            _pool.put_nowait(conn)
+            return
+        except queue.Full:
+            pass
+    sqlite3.Connection.close(conn)
 
 
 def create_conn():
-    conn = sqlite3.connect("db.sqlite")
-    return conn, conn.cursor()
+    # one pooled connection per request, returned to the pool on teardown
+    if has_app_context():
+        conn = g.get("db_conn")
+        if conn is None:
+            conn = g.db_conn = _acquire_conn()
+    else:
+        conn = _acquire_conn()
+    return conn, conn.cursor(metrics.TimedCursor)
+
+
+def teardown_conn(exception=None):
+    conn = g.pop("db_conn", None)
+    if conn is not None:
+        release_conn(conn)
+
+
+def _statements(script):
+    statement = ""
+    for line in script.splitlines(keepends=True):
+        statement += line
+        if sqlite3.complete_statement(statement):
+            yield statement
+            statement = ""
+
+
+def migrate(conn, migrations):
+    # applies the migrations past the database's user_version, each in its own
+    # transaction, so a partly applied migration never sticks
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for number, script in enumerate(migrations[version:], start=version + 1):
+        conn.execute("BEGIN IMMEDIATE")
+        # another worker may have migrated while we waited for the lock
+        if conn.execute("PRAGMA user_version").fetchone()[0] >= number:
+            conn.rollback()
+            continue
+        for statement in _statements(script):
+            conn.execute(statement)
+        conn.execute("PRAGMA user_version = %d" % (number,))
+        conn.commit()
+
+
+def full_scans(db, query):
+    # steps of the query plan that read a whole table rather than an index
+    params = (
+        (None,) * query.count("?")
+        if "?" in query
+        else collections.defaultdict(lambda: None)
+    )
+    plan = db.execute("EXPLAIN QUERY PLAN " + query, params).fetchall()
+    return [
+        row[-1]
+        for row in plan
+        if row[-1].startswith("SCAN")
+        and "USING" not in row[-1]
+        and "CONSTANT ROW" not in row[-1]
+    ]
+
+
+# bcrypt runs in a few worker processes so a burst of logins can't take every
+# request thread's CPU, and at most HASH_SLOTS hashes are running or waiting
+HASH_WORKERS = int(os.environ.get("HASH_WORKERS", max(1, (os.cpu_count() or 2) // 2)))
+HASH_SLOTS = HASH_WORKERS * 2
+HASH_WAIT = 5  # seconds a request waits for a slot before giving up
+_hash_slots = threading.BoundedSemaphore(HASH_SLOTS)
+_hash_pool = None
+_hash_pool_pid = None
+_hash_pool_lock = threading.Lock()
+
+
+def _bytes(value):
+    return value.encode() if isinstance(value, str) else value
+
+
+def _hashpw(plain_text_password):
+    hashed = bcrypt.hashpw(_bytes(plain_text_password), bcrypt.gensalt())
+    return hashed.decode() if isinstance(hashed, bytes) else hashed
+
+
+def _checkpw(plain_text_password, hashed_password):
+    return bcrypt.checkpw(_bytes(plain_text_password), _bytes(hashed_password))
+
+
+def _run_hash(fn, *args):
+    # returns None if no slot frees up within HASH_WAIT
+    global _hash_pool, _hash_pool_pid
+    if not _hash_slots.acquire(timeout=HASH_WAIT):
+        return None
+    try:
+        with _hash_pool_lock:
+            # worker processes don't survive a fork of this one
+            if _hash_pool is None or _hash_pool_pid != os.getpid():
+                _hash_pool = ProcessPoolExecutor(HASH_WORKERS)
+                _hash_pool_pid = os.getpid()
+        return _hash_pool.submit(fn, *args).result()
+    finally:
+        _hash_slots.release()
 
 
 def get_hashed_password(plain_text_password):
     # Hash a password for the first time
     #   (Using bcrypt, the salt is saved into the hash itself)
-    return bcrypt.hashpw(plain_text_password, bcrypt.gensalt())
+    # None if too many hashes are already queued
+    return _run_hash(_hashpw, plain_text_password)
 
 
 def check_password(plain_text_password, hashed_password):
     # Check hashed password. Using bcrypt, the salt is saved into the hash itself
-    return bcrypt.checkpw(plain_text_password, hashed_password)
+    # None if too many hashes are already queued
+    return _run_hash(_checkpw, plain_text_password, hashed_password)
 
 
 def get_token():
     return secrets.token_urlsafe()
 
 
+TOKEN_CACHE_SIZE = 4096
+TOKEN_CACHE_TTL = 60  # seconds, bounds how stale another worker's view can be
+
+# token -> (uid, expiry), least recently used first
+_token_cache = collections.OrderedDict()
+_token_cache_lock = threading.Lock()
+token_cache_stats = {"hits": 0, "misses": 0}
+
+
+def authd_uid(db, args):
+    # uid of the approved user holding an unexpired token, or None
+    token = args.get("token")
+    if not token:
+        return None
+    now = time.monotonic()
+    with _token_cache_lock:
+        entry = _token_cache.get(token)
+        if entry is not None and entry[1] > now:
+            _token_cache.move_to_end(token)
+            token_cache_stats["hits"] += 1
+            return entry[0]
+        token_cache_stats["misses"] += 1
+    row = db.execute(
+        "SELECT id FROM users WHERE token = ? AND approved = 1 AND token_created >= date('now', '-1 days')",
+        (token,),
+    ).fetchone()
+    with _token_cache_lock:
+        if row is None:
+            _token_cache.pop(token, None)
+            return None
+        _token_cache[token] = (row[0], now + TOKEN_CACHE_TTL)
+        _token_cache.move_to_end(token)
+        while len(_token_cache) > TOKEN_CACHE_SIZE:
+            _token_cache.popitem(last=False)
+    return row[0]
+
+
 def is_authd(db, args):
-    if args.get("token"):
-        res = db.execute(
-            "SELECT COUNT(*) FROM users WHERE token = ? AND approved = 1 AND token_created >= date('now', '-1 days')",
-            (args.get("token"),),
-        ).fetchone()
-        return res[0] == 1
-    return False
+    return authd_uid(db, args) is not None
+
+
+def token_cache_info():
+    with _token_cache_lock:
+        return dict(token_cache_stats, size=len(_token_cache))
+
+
+def invalidate_user_tokens(uid):
+    with _token_cache_lock:
+        for token in [t for t, e in _token_cache.items() if e[0] == int(uid)]:
+            del _token_cache[token]
 
 
 def login(db, args):
+    # None if the password couldn't be checked right now
     if args.get("email") and args.get("password"):
         hashed = db.execute(
             "SELECT password FROM users WHERE email = ?", (args.get("email"),)
@@ -60,29 +317,37 @@ def login(db, args):
     return False
 
 
-def send_email(to, message, subject=""):
+# seconds to wait on each step of talking to the mail relay or Slack
+NOTIFY_TIMEOUT = 10
+
+
+def send_email(to, message, subject="", smtp=None):
+    # smtp is an open connection to reuse
     msg = MIMEText(message)
     msg["Subject"] = subject
     msg["From"] = "ipp@cbica.upenn.edu"
     msg["To"] = to
-    s = smtplib.SMTP("localhost")
+    s = smtp or smtplib.SMTP("localhost", timeout=NOTIFY_TIMEOUT)
     s.send_message(msg)
-    s.quit()
+    if smtp is None:
+        s.quit()
 
 
-def send_slack_message(to, message, channel=None):
+def send_slack_message(to, message, channel=None, session=None):
     payload = {"text": message, "username": "Image Processing Portal"}
     if channel:
         payload["channel"] = channel
-    response = requests.post(
+    response = (session or requests).post(
         to,
         data=json.dumps(payload),
         headers={"Content-Type": "application/json"},
+        timeout=NOTIFY_TIMEOUT,
     )
     return response.status_code == 200
 
 
-def notify_admin(request, uid):
+def notify_admin(db, request, uid):
+    # queued in the outbox, call helpers.outbox.wake() after committing
     user_form = request.form.to_dict(flat=True)
     del user_form["password"]
     del user_form["confirm-password"]
@@ -92,10 +357,137 @@ def notify_admin(request, uid):
         + json.dumps(user_form)
         + "\nClick %susers/approve/%d to approve" % (request.url_root, uid)
     )
+    from helpers import outbox  # which imports this module
+
     if "ADMIN_EMAIL" in os.environ:
-        send_email(os.environ["ADMIN_EMAIL"], message)
+        outbox.enqueue(db, "email", os.environ["ADMIN_EMAIL"], message)
     if "ADMIN_SLACK" in os.environ:
-        send_slack_message(os.environ["ADMIN_SLACK"], message)
+        outbox.enqueue(db, "slack_message", os.environ["ADMIN_SLACK"], message)
+
+
+# bumped whenever an experiment changes in this process, so event streams can
+# wake up right away instead of waiting for their next poll
+_changes = threading.Condition()
+_changes_version = 0
+
+
+def notify_changes():
+    global _changes_version
+    with _changes:
+        _changes_version += 1
+        _changes.notify_all()
+
+
+def changes_version():
+    return _changes_version
+
+
+def wait_for_changes(version, timeout):
+    # changes committed by other worker processes are only seen on timeout
+    with _changes:
+        _changes.wait_for(lambda: _changes_version != version, timeout)
+
+
+# touched whenever a job is submitted, so pollers waiting in other worker
+# processes notice without querying the database
+QUEUE_NOTIFY_PATH = DB_PATH + "-queue"
+QUEUE_NOTIFY_INTERVAL = 0.5  # seconds between checks of QUEUE_NOTIFY_PATH
+
+_jobs = threading.Condition()
+_jobs_version = 0
+
+
+def _queue_stamp():
+    try:
+        return os.stat(QUEUE_NOTIFY_PATH).st_mtime_ns
+    except FileNotFoundError:
+        return 0
+
+
+def queue_state():
+    # taken before looking at the queue, so nothing submitted after the look
+    # is missed by wait_for_job
+    return _jobs_version, _queue_stamp()
+
+
+def notify_job():
+    global _jobs_version
+    with _jobs:
+        _jobs_version += 1
+        _jobs.notify_all()
+    with open(QUEUE_NOTIFY_PATH, "a"):
+        os.utime(QUEUE_NOTIFY_PATH)
+
+
+def wait_for_job(state, timeout):
+    # returns True once a job may have been submitted since state was taken,
+    # in this process or another, or False after timeout seconds
+    deadline = time.monotonic() + timeout
+    with _jobs:
+        while queue_state() == state:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            _jobs.wait(min(remaining, QUEUE_NOTIFY_INTERVAL))
+    return True
+
+
+def listing_etag(uid, count, seq, args):
+    # the login token isn't part of what's listed
+    key = json.dumps(
+        [uid, count, seq, sorted((k, v) for k, v in args.items() if k != "token")]
+    )
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+# Backend and admin routes only answer requests from this host. A proxy on this
+# host (e.g. nginx in front of the app) makes every request come from
+# 127.0.0.1, so anything carrying the headers a proxy adds is refused too, and
+# with LOCAL_TOKEN set the caller must also send it as X-Local-Token.
+LOCAL_TOKEN = os.environ.get("LOCAL_TOKEN")
+FORWARDED_HEADERS = ("X-Forwarded-For", "X-Real-IP", "Forwarded")
+
+
+def is_local(request):
+    if request.remote_addr != "127.0.0.1":
+        return False
+    if any(header in request.headers for header in FORWARDED_HEADERS):
+        return False
+    return LOCAL_TOKEN is None or secrets.compare_digest(
+        request.headers.get("X-Local-Token", ""), LOCAL_TOKEN
+    )
+
+
+def file_etag(path):
+    # strong, changes whenever the file is replaced or rewritten
+    st = os.stat(path)
+    return "%x-%x-%x" % (st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+def accel_redirect(path):
+    location = os.environ["X_ACCEL_REDIRECT"].rstrip("/")
+    relative = os.path.relpath(path, os.environ["UPLOAD_FOLDER"])
+    response = Response(
+        mimetype=mimetypes.guess_type(path)[0] or "application/octet-stream"
+    )
+    response.headers["X-Accel-Redirect"] = location + "/" + urllib.parse.quote(relative)
+    return response
+
+
+def experiment_of(path):
+    # id of the experiment a path under UPLOAD_FOLDER/uid/<namespace>/eid belongs to
+    parts = os.path.relpath(path, os.environ["UPLOAD_FOLDER"]).split(os.sep)
+    if len(parts) >= 3 and parts[2].isdigit():
+        return int(parts[2])
+    return None
+
+
+def remove_path(path):
+    # paths handed to the reapers are input files or output folders, returns
+    # the bytes freed
+    if path is None:
+        return 0
+    return storage.backend().delete(path)
 
 
 def extract_params(params, backend=False):
@@ -109,10 +501,11 @@ def extract_params(params, backend=False):
         elif param[0] == "experimentName":
             experimentName = param[1]
         else:
-            # the backend server places downloaded files in "inputs"
+            # the backend server extracts downloaded files into "inputs", and
+            # archive entries are relative to the experiment's submitted folder
             new_params[param[0]] = (
                 param[1]
                 if not backend or not param[1].startswith(os.environ["UPLOAD_FOLDER"])
-                else "inputs" + param[1]
+                else os.path.join("inputs", os.path.basename(param[1]))
             )
     return app, experimentDescription, experimentName, new_params
@@ -0,0 +1,94 @@
+import os
+import shutil
+import hashlib
+import secrets
+import tempfile
+from helpers import storage
+
+CHUNK_SIZE = 1024 * 1024
+# what inputs were saved with before the store, mkstemp's files are 0600
+FILE_MODE = 0o644
+
+# Inputs are stored once per distinct content under UPLOAD_FOLDER/blobs, named
+# by their sha256, and each experiment's copy is a hardlink to the blob. The
+# blobs table counts the files rows that hold a reference to each blob. With
+# the S3 backend the blobs are objects and each copy is an empty object that
+# refers to its blob (see helpers/storage.py).
+
+
+def blob_path(digest):
+    return os.path.join(os.environ["UPLOAD_FOLDER"], "blobs", digest[:2], digest)
+
+
+def receive(stream, limit):
+    # writes stream to a temporary file in the blob area, hashing it on the way,
+    # returns (temporary path, sha256, size) or None if it's larger than limit
+    folder = os.path.join(os.environ["UPLOAD_FOLDER"], "blobs", "tmp")
+    os.makedirs(folder, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=folder)
+    # backends and nginx may run as another user
+    os.fchmod(fd, FILE_MODE)
+    sha = hashlib.sha256()
+    size = 0
+    with os.fdopen(fd, "wb") as f:
+        while size <= limit:
+            chunk = stream.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            size += len(chunk)
+            sha.update(chunk)
+            f.write(chunk)
+    if size > limit:
+        os.remove(tmp)
+        return None
+    return tmp, sha.hexdigest(), size
+
+
+def stage(path):
+    # a temporary copy of path in the blob area for store() to take, linked
+    # when it can be, so path is left alone until the caller removes it
+    folder = os.path.join(os.environ["UPLOAD_FOLDER"], "blobs", "tmp")
+    os.makedirs(folder, exist_ok=True)
+    tmp = os.path.join(folder, secrets.token_hex(8))
+    try:
+        os.link(path, tmp)
+    except OSError:
+        shutil.copyfile(path, tmp)
+    return tmp
+
+
+def store(db, tmp, digest, size, dest):
+    # moves tmp into the store unless the same content is already there, links
+    # dest to the blob and takes a reference on it
+    store = storage.backend()
+    path = blob_path(digest)
+    store.makedirs(os.path.dirname(path))
+    if store.exists(path):
+        os.remove(tmp)
+    else:
+        store.save(tmp, path)
+    store.link(path, dest)
+    db.execute(
+        "INSERT OR IGNORE INTO blobs (hash, size, refs) VALUES (?, ?, 0)",
+        (digest, size),
+    )
+    db.execute("UPDATE blobs SET refs = refs + 1 WHERE hash = ?", (digest,))
+
+
+def release(db, digest):
+    # drops a reference, returns the blob's path once nothing refers to it so
+    # the caller can remove it after committing
+    db.execute("UPDATE blobs SET refs = refs - 1 WHERE hash = ?", (digest,))
+    refs = db.execute("SELECT refs FROM blobs WHERE hash = ?", (digest,)).fetchone()
+    if refs is not None and refs[0] <= 0:
+        db.execute("DELETE FROM blobs WHERE hash = ?", (digest,))
+        return blob_path(digest)
+    return None
+
+
+def discard_unreferenced(db, digests):
+    # removes blobs written by a request that was rolled back
+    for digest in digests:
+        if db.execute("SELECT 1 FROM blobs WHERE hash = ?", (digest,)).fetchone():
+            continue
+        storage.backend().delete(blob_path(digest))
@@ -0,0 +1,106 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+import helpers
+from helpers import storage
+
+# The outputs table catalogs every file the backend uploaded to
+# UPLOAD_FOLDER/uid/completed/eid, so the reaper can find old outputs with an
+# index range query instead of walking the whole upload folder.
+
+RECONCILE_WORKERS = 16
+BACKFILL_JOB = "backfill-outputs"
+
+insert_output = (
+    "INSERT OR REPLACE INTO outputs (eid, path, size, mtime) VALUES (?, ?, ?, ?)"
+)
+# the output_backfill migration's job, unless it already ran or is running.
+# One that failed, e.g. because its process exited, is run again
+claim_backfill_job = "UPDATE jobs SET failed = 0, finished = NULL, updated = CURRENT_TIMESTAMP WHERE id = ? AND (failed = 1 OR (finished IS NULL AND updated IS NULL))"
+
+
+def record(db, eid, path, version=None):
+    # version is path's (size, mtime) if the caller already has it
+    size, mtime = storage.backend().stat(path) if version is None else version
+    db.execute(insert_output, (eid, path, size, mtime))
+    return size
+
+
+def claim_backfill(db):
+    # True if this process should run backfill() once db is committed
+    db.execute(claim_backfill_job, (BACKFILL_JOB,))
+    return db.rowcount == 1
+
+
+def backfill():
+    # catalogs the outputs already in every experiment folder in the
+    # background, one folder at a time, poll /jobs/backfill-outputs
+    helpers.jobs.start(BACKFILL_JOB, _folders(storage.backend()), _backfill_folder)
+
+
+def _backfill_folder(folder):
+    eid = os.path.basename(folder)
+    if not eid.isdigit():
+        return 0
+    folder, found = _scan(folder)
+    conn, db = helpers.create_conn()
+    # what was uploaded meanwhile is already cataloged
+    db.executemany(
+        "INSERT OR IGNORE INTO outputs (eid, path, size, mtime) VALUES (?, ?, ?, ?)",
+        [(int(eid), path) + version for path, version in found.items()],
+    )
+    conn.commit()
+    conn.close()
+    return 0
+
+
+def _scan(folder):
+    # hidden files are the manifest, see helpers/manifests.py, and temporaries
+    found = {
+        path: (size, mtime)
+        for path, size, mtime in storage.backend().walk(folder)
+        if not os.path.basename(path).startswith(".")
+    }
+    return folder, found
+
+
+def _folders(store):
+    # every UPLOAD_FOLDER/uid/completed/eid
+    root = os.environ["UPLOAD_FOLDER"]
+    for uid in store.list(root):
+        completed = os.path.join(root, uid, "completed")
+        for eid in store.list(completed):
+            yield os.path.join(completed, eid)
+
+
+def reconcile(db, fix=True, workers=RECONCILE_WORKERS):
+    # compares the catalog with what's on disk, walking experiment folders in
+    # parallel, returns (missing, stale, changed) paths, fixing the catalog
+    # unless fix is False
+    folders = list(_folders(storage.backend()))
+    on_disk = {}
+    eids = {}
+    with ThreadPoolExecutor(workers) as pool:
+        for folder, found in pool.map(_scan, folders):
+            eid = os.path.basename(folder)
+            if not eid.isdigit():
+                continue
+            on_disk.update(found)
+            for path in found:
+                eids[path] = int(eid)
+    catalog = {
+        row[0]: (row[1], row[2])
+        for row in db.execute("SELECT path, size, mtime FROM outputs")
+    }
+    missing = [path for path in on_disk if path not in catalog]
+    stale = [path for path in catalog if path not in on_disk]
+    changed = [
+        path
+        for path, entry in catalog.items()
+        if path in on_disk and on_disk[path] != entry
+    ]
+    if fix:
+        for path in stale:
+            db.execute("DELETE FROM outputs WHERE path = ?", (path,))
+        for path in missing + changed:
+            db.execute(insert_output, (eids[path], path) + on_disk[path])
+    return missing, stale, changed
@@ -0,0 +1,89 @@
+import os
+import time
+import secrets
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import helpers
+
+# Background jobs run a function over a list of items on a worker pool and
+# record their progress in the jobs table, so any worker process can report it.
+# A job whose progress hasn't been updated for STALE_AFTER died with its process
+# and is marked finished and failed, so whoever polls it doesn't wait forever.
+
+WORKERS = int(os.environ.get("JOB_WORKERS", "8"))
+PROGRESS_INTERVAL = 1.0  # seconds between progress updates
+STALE_AFTER = 60  # seconds
+
+update_progress = "UPDATE jobs SET done = ?, bytes = ?, errors = ?, updated = CURRENT_TIMESTAMP WHERE id = ?"
+finish_job = "UPDATE jobs SET done = ?, bytes = ?, errors = ?, failed = ?, updated = CURRENT_TIMESTAMP, finished = CURRENT_TIMESTAMP WHERE id = ?"
+abandon_jobs = "UPDATE jobs SET failed = 1, finished = CURRENT_TIMESTAMP WHERE finished IS NULL AND COALESCE(updated, created) < datetime('now', :age) AND (:id IS NULL OR id = :id)"
+
+_executor = ThreadPoolExecutor(WORKERS)
+
+
+def create(db, kind, total):
+    job_id = secrets.token_hex(8)
+    db.execute(
+        "INSERT INTO jobs (id, kind, total) VALUES (?, ?, ?)", (job_id, kind, total)
+    )
+    return job_id
+
+
+def start(job_id, items, work, executor=None, then=None):
+    # work(item) returns the bytes it freed, call once the job's row is
+    # committed. then() runs once every item is done, before the job finishes
+    threading.Thread(
+        target=_run,
+        args=(job_id, items, work, executor or _executor, then),
+        daemon=True,
+    ).start()
+
+
+def _run(job_id, items, work, executor, then):
+    done = freed = errors = 0
+    failed = True
+    try:
+        pending = set(executor.submit(work, item) for item in items)
+        last = time.monotonic()
+        while pending:
+            # wakes up every interval even if nothing finished, as a heartbeat
+            finished, pending = wait(
+                pending, timeout=PROGRESS_INTERVAL, return_when=FIRST_COMPLETED
+            )
+            for future in finished:
+                try:
+                    freed += future.result() or 0
+                except Exception:
+                    errors += 1
+                done += 1
+            if time.monotonic() - last >= PROGRESS_INTERVAL:
+                _update(update_progress, (done, freed, errors, job_id))
+                last = time.monotonic()
+        if then is not None:
+            then()
+        failed = False
+    finally:
+        _update(finish_job, (done, freed, errors, failed, job_id))
+
+
+def _update(sql, params):
+    conn, db = helpers.create_conn()
+    db.execute(sql, params)
+    conn.commit()
+    conn.close()
+
+
+def abandon(db, job_id=None):
+    # marks unfinished jobs that stopped updating their progress as failed
+    db.execute(abandon_jobs, {"age": "-%d seconds" % (STALE_AFTER,), "id": job_id})
+
+
+def status(db, job_id):
+    row = db.execute(
+        "SELECT id, kind, total, done, bytes, errors, created, finished, failed FROM jobs WHERE id = ?",
+        (job_id,),
+    ).fetchone()
+    if row is None:
+        return None
+    keys = ["id", "kind", "total", "done", "bytes", "errors", "created", "finished"]
+    return dict(zip(keys, row), failed=bool(row[8]))
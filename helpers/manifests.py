@@ -0,0 +1,143 @@
+import os
+import json
+import secrets
+import threading
+import collections
+from helpers import storage
+from helpers import tiering
+
+# upload_results writes UPLOAD_FOLDER/uid/completed/eid/.manifest.json with the
+# name, size and sha256 of each output, so listing an experiment's outputs
+# reads one small file instead of listing the folder, which is a round trip per
+# experiment on NFS. What was read is kept in memory for as long as the
+# experiment's seq stays the same, since every change to its outputs bumps it.
+# A missing manifest, e.g. for outputs uploaded before manifests existed, is
+# rebuilt from the folder the first time it's asked for, without checksums.
+
+MANIFEST_NAME = ".manifest.json"
+MANIFEST_CACHE_SIZE = 4096
+
+# folder -> (seq, outputs), least recently used first
+_cache = collections.OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def manifest_path(folder):
+    return os.path.join(folder, MANIFEST_NAME)
+
+
+def _scan(folder):
+    # the outputs in folder by the names users know them by
+    outputs = {}
+    for path, size, mtime in storage.backend().walk(folder):
+        name = os.path.relpath(path, folder)
+        if not os.path.basename(name).startswith("."):
+            outputs[tiering.original_name(name)] = {"size": size, "sha256": None}
+    return outputs
+
+
+def _read(folder):
+    # the manifest's outputs, None if there's no manifest
+    try:
+        with storage.backend().open(manifest_path(folder)) as f:
+            return json.loads(f.read().decode())
+    except FileNotFoundError:
+        return None
+
+
+def _write(folder, outputs):
+    store = storage.backend()
+    # written next to the manifest so it's replaced atomically on local storage
+    tmp_folder = folder if store.local else os.environ["UPLOAD_FOLDER"]
+    tmp = os.path.join(tmp_folder, ".%s.%s.tmp" % (MANIFEST_NAME, secrets.token_hex(4)))
+    with open(tmp, "w") as f:
+        json.dump(outputs, f, sort_keys=True)
+        f.flush()
+        os.fsync(f.fileno())
+    store.save(tmp, manifest_path(folder))
+    _drop(folder)
+
+
+def _drop(folder):
+    with _cache_lock:
+        _cache.pop(folder, None)
+
+
+def _cached(folder, seq):
+    with _cache_lock:
+        entry = _cache.get(folder)
+        if entry is None or entry[0] != seq:
+            return None
+        _cache.move_to_end(folder)
+        return entry[1]
+
+
+def _remember(folder, seq, outputs):
+    with _cache_lock:
+        _cache[folder] = (seq, outputs)
+        _cache.move_to_end(folder)
+        while len(_cache) > MANIFEST_CACHE_SIZE:
+            _cache.popitem(last=False)
+
+
+def outputs(folder, seq):
+    # {name: {"size": ..., "sha256": ...}} for the outputs in folder as of the
+    # experiment's seq, {} if there's no such folder
+    found = _cached(folder, seq)
+    if found is not None:
+        return found
+    found = _read(folder)
+    if found is None:
+        found = _scan(folder)
+        # nothing to write for a folder that's missing, e.g. deleted
+        if found:
+            _write(folder, found)
+    _remember(folder, seq, found)
+    return found
+
+
+def names(folder, seq):
+    return sorted(outputs(folder, seq))
+
+
+def listing(folder, seqs):
+    # {eid: names} for folder/eid, a user's completed experiments, given
+    # {eid: seq}. Only the manifests that aren't cached are read
+    return {
+        eid: names(os.path.join(folder, str(eid)), seq) for eid, seq in seqs.items()
+    }
+
+
+def add(folder, published):
+    # records published {name: (size, sha256)}, call while holding the
+    # database's write lock so updates to one manifest don't interleave
+    _drop(folder)
+    found = _read(folder)
+    found = dict(_scan(folder) if found is None else found)
+    for name, (size, digest) in published.items():
+        found[name] = {"size": size, "sha256": digest}
+    _write(folder, found)
+
+
+def by_experiment(paths):
+    # {folder: names} of the outputs among paths, by their experiment's folder
+    # UPLOAD_FOLDER/uid/completed/eid
+    upload_folder = os.environ["UPLOAD_FOLDER"]
+    found = {}
+    for path in paths:
+        parts = os.path.relpath(path, upload_folder).split(os.sep)
+        if len(parts) >= 4 and parts[1] == "completed":
+            folder = os.path.join(upload_folder, *parts[:3])
+            name = tiering.original_name(os.path.join(*parts[3:]))
+            found.setdefault(folder, set()).add(name)
+    return found
+
+
+def forget(folder, names):
+    # drops names from folder's manifest once they're removed, call while
+    # holding the database's write lock so it doesn't interleave with add
+    _drop(folder)
+    found = _read(folder)
+    if found is None or not names & set(found):
+        return
+    _write(folder, {name: o for name, o in found.items() if name not in names})
@@ -0,0 +1,143 @@
+import re
+import time
+import sqlite3
+import threading
+import functools
+
+# In-process counters and histograms rendered in the Prometheus text format by
+# /metrics. Each worker process keeps its own, so scrape every worker (or run
+# a single one) to see the whole picture.
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+METRICS = {
+    "ipp_http_request_duration_seconds": (
+        "histogram",
+        "Time to handle a request, up to the first byte of streamed responses",
+    ),
+    "ipp_http_request_bytes_total": ("counter", "Request body bytes received"),
+    "ipp_http_response_bytes_total": ("counter", "Response body bytes sent"),
+    "ipp_sql_query_duration_seconds": (
+        "histogram",
+        "Time to execute a query, up to its first row",
+    ),
+    "ipp_notification_send_duration_seconds": (
+        "histogram",
+        "Time to deliver a batch of notifications",
+    ),
+}
+
+_lock = threading.Lock()
+_histograms = {}  # (name, labels) -> [count per bucket..., +Inf count, sum]
+_counters = {}  # (name, labels) -> value
+
+
+def observe(name, labels, value):
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = [0] * (len(LATENCY_BUCKETS) + 2)
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if value <= bound:
+                histogram[i] += 1
+        histogram[-2] += 1
+        histogram[-1] += value
+
+
+def inc(name, labels, value=1):
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def counted(iterable, name, labels):
+    # counts the bytes of a streamed response as they're sent
+    for chunk in iterable:
+        inc(name, labels, len(chunk))
+        yield chunk
+
+
+@functools.lru_cache(maxsize=1024)
+def query_name(sql):
+    # "SELECT experiments", "UPDATE outbox", ... so labels stay few
+    verb = sql.split(None, 1)[0].upper() if sql.strip() else ""
+    if verb == "UPDATE":
+        match = re.search(r"^\s*UPDATE\s+(?:OR\s+\w+\s+)?(\w+)", sql, re.IGNORECASE)
+    else:
+        match = re.search(r"\b(?:FROM|INTO)\s+(\w+)", sql, re.IGNORECASE)
+    return verb if match is None else "%s %s" % (verb, match.group(1))
+
+
+# statements run by this thread are appended to recording.statements while
+# it's a list, see helpers.profiling
+recording = threading.local()
+
+
+def _record(sql, start):
+    elapsed = time.perf_counter() - start
+    observe("ipp_sql_query_duration_seconds", {"query": query_name(sql)}, elapsed)
+    statements = getattr(recording, "statements", None)
+    if statements is not None:
+        statements.append((sql, elapsed))
+
+
+class TimedCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            _record(sql, start)
+
+    def executemany(self, sql, seq_of_parameters):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            _record(sql, start)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (k, _escape(v)) for k, v in labels)
+
+
+def _header(lines, name, kind, text):
+    lines.append("# HELP %s %s" % (name, text))
+    lines.append("# TYPE %s %s" % (name, kind))
+
+
+def render(gauges=()):
+    # gauges are (name, type, help, [(labels dict, value)]) computed by the
+    # caller at scrape time
+    with _lock:
+        histograms = {k: list(v) for k, v in _histograms.items()}
+        counters = dict(_counters)
+    lines = []
+    for name, (kind, text) in METRICS.items():
+        _header(lines, name, kind, text)
+        if kind == "histogram":
+            for (key, labels), histogram in sorted(histograms.items()):
+                if key != name:
+                    continue
+                for bound, count in zip(LATENCY_BUCKETS, histogram):
+                    le = labels + (("le", "%g" % bound),)
+                    lines.append("%s_bucket%s %d" % (name, _labels(le), count))
+                le = labels + (("le", "+Inf"),)
+                lines.append("%s_bucket%s %d" % (name, _labels(le), histogram[-2]))
+                lines.append("%s_sum%s %f" % (name, _labels(labels), histogram[-1]))
+                lines.append("%s_count%s %d" % (name, _labels(labels), histogram[-2]))
+        else:
+            for (key, labels), value in sorted(counters.items()):
+                if key == name:
+                    lines.append("%s%s %d" % (name, _labels(labels), value))
+    for name, kind, text, samples in gauges:
+        _header(lines, name, kind, text)
+        for labels, value in samples:
+            lines.append("%s%s %s" % (name, _labels(sorted(labels.items())), value))
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,160 @@
+import os
+import time
+import smtplib
+import secrets
+import threading
+import collections
+import requests
+import helpers
+
+# Notifications are written to the outbox table in the caller's transaction and
+# delivered by a background thread, so requests never wait on the mail relay or
+# Slack. Messages due for the same destination are sent as one, failed ones are
+# retried with exponential backoff until MAX_ATTEMPTS, after which they stay in
+# the table with next_attempt NULL and the last error.
+
+CHANNELS = ["email", "slack_message"]
+POLL_INTERVAL = 5  # seconds, picks up messages queued by other processes
+BATCH_SIZE = 100
+# claimed messages are sent within the lease, which has to stay well above
+# helpers.NOTIFY_TIMEOUT: the ones still unsent after half of it are released
+# for the next poll rather than risk another worker sending them too
+LEASE_SECONDS = 60
+RETRY_BASE = 30  # seconds before the first retry, doubled after each one
+RETRY_MAX = 3600
+MAX_ATTEMPTS = 10
+
+insert_message = (
+    "INSERT INTO outbox (channel, destination, subject, message) VALUES (?, ?, ?, ?)"
+)
+claim_messages = "UPDATE outbox SET lease = :lease, lease_expires = datetime('now', '+' || :seconds || ' seconds') WHERE id IN (SELECT id FROM outbox WHERE next_attempt <= datetime('now') AND (lease_expires IS NULL OR lease_expires < datetime('now')) ORDER BY next_attempt LIMIT :limit)"
+release_messages = (
+    "UPDATE outbox SET lease = NULL, lease_expires = NULL WHERE lease = ?"
+)
+select_claimed = "SELECT id, channel, destination, subject, message, attempts FROM outbox WHERE lease = ? ORDER BY id"
+retry_message = "UPDATE outbox SET attempts = attempts + 1, error = :error, lease = NULL, lease_expires = NULL, next_attempt = CASE WHEN attempts + 1 >= :max THEN NULL ELSE datetime('now', '+' || :delay || ' seconds') END WHERE id = :id"
+
+_wake = threading.Event()
+_worker_pid = None
+_start_lock = threading.Lock()
+_smtp = None
+_session = requests.Session()
+
+
+def enqueue(db, channel, to, message, subject=""):
+    # call wake() once the transaction is committed
+    db.execute(insert_message, (channel, to, subject, message))
+
+
+def start():
+    # (re)starts this process's delivery thread, threads don't survive a fork
+    global _worker_pid
+    with _start_lock:
+        if _worker_pid == os.getpid():
+            return
+        _worker_pid = os.getpid()
+        threading.Thread(target=_work, daemon=True).start()
+
+
+def wake():
+    start()
+    _wake.set()
+
+
+def _work():
+    while True:
+        _wake.wait(POLL_INTERVAL)
+        _wake.clear()
+        try:
+            while deliver() == BATCH_SIZE:
+                pass
+        except Exception:
+            # e.g. the database is locked, try again on the next poll
+            pass
+        _close_smtp()
+
+
+def deliver():
+    # sends the messages that are due, returns how many were claimed
+    lease = secrets.token_hex(8)
+    deadline = time.monotonic() + LEASE_SECONDS / 2
+    conn, db = helpers.create_conn()
+    db.execute(
+        claim_messages, {"lease": lease, "seconds": LEASE_SECONDS, "limit": BATCH_SIZE}
+    )
+    conn.commit()
+    rows = db.execute(select_claimed, (lease,)).fetchall()
+    conn.close()
+    batches = collections.OrderedDict()
+    for row in rows:
+        batches.setdefault((row[1], row[2]), []).append(row)
+    for (channel, to), batch in batches.items():
+        if time.monotonic() > deadline:
+            # the rest weren't sent, they're released for the next poll
+            conn, db = helpers.create_conn()
+            db.execute(release_messages, (lease,))
+            conn.commit()
+            conn.close()
+            break
+        start = time.perf_counter()
+        try:
+            _send(channel, to, batch)
+            error = None
+        except Exception as e:
+            error = str(e) or type(e).__name__
+        helpers.metrics.observe(
+            "ipp_notification_send_duration_seconds",
+            {"channel": channel, "result": "sent" if error is None else "failed"},
+            time.perf_counter() - start,
+        )
+        conn, db = helpers.create_conn()
+        for row in batch:
+            if error is None:
+                db.execute("DELETE FROM outbox WHERE id = ?", (row[0],))
+            else:
+                db.execute(
+                    retry_message,
+                    {
+                        "error": error,
+                        "max": MAX_ATTEMPTS,
+                        "delay": min(RETRY_BASE * 2 ** row[5], RETRY_MAX),
+                        "id": row[0],
+                    },
+                )
+        conn.commit()
+        conn.close()
+    return len(rows)
+
+
+def _send(channel, to, batch):
+    message = "\n\n".join(row[4] for row in batch)
+    subjects = set(row[3] for row in batch)
+    subject = subjects.pop() if len(subjects) == 1 else "%d notifications" % len(batch)
+    if channel == "email":
+        try:
+            helpers.send_email(to, message, subject, smtp=_smtp_conn())
+        except Exception:
+            _close_smtp()
+            raise
+    elif channel == "slack_message":
+        if not helpers.send_slack_message(to, message, session=_session):
+            raise RuntimeError("slack rejected the message")
+    else:
+        raise ValueError("unknown notification channel %s" % (channel,))
+
+
+def _smtp_conn():
+    global _smtp
+    if _smtp is None:
+        _smtp = smtplib.SMTP("localhost", timeout=helpers.NOTIFY_TIMEOUT)
+    return _smtp
+
+
+def _close_smtp():
+    global _smtp
+    if _smtp is not None:
+        try:
+            _smtp.quit()
+        except Exception:
+            pass
+        _smtp = None
@@ -0,0 +1,142 @@
+import os
+import re
+import json
+import time
+import pstats
+import cProfile
+from helpers import metrics
+
+# Requests are profiled with cProfile when they come from localhost with an
+# X-Profile header, or when their route is armed through POST /profiles. Each
+# profile is written to PROFILE_DIR as <name>.prof (for pstats / snakeviz) and
+# <name>.txt (the request's SQL statements and the slowest functions), keeping
+# the newest MAX_PROFILES. Arming is stored in PROFILE_DIR so every worker
+# process sees it, and each request only pays for a clock read while nothing
+# is armed.
+
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+MAX_PROFILES = 100
+ARM_CHECK_INTERVAL = 1.0  # seconds between checks for newly armed routes
+TOP_FUNCTIONS = 40
+
+_armed = {}  # route -> time.time() it's armed until, "*" arms every route
+_armed_mtime = None
+_armed_checked = 0.0
+
+
+def _armed_path():
+    return os.path.join(PROFILE_DIR, "armed.json")
+
+
+def _read_armed():
+    try:
+        with open(_armed_path()) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def armed():
+    global _armed, _armed_mtime, _armed_checked
+    now = time.monotonic()
+    if now - _armed_checked >= ARM_CHECK_INTERVAL:
+        _armed_checked = now
+        try:
+            mtime = os.stat(_armed_path()).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if mtime != _armed_mtime:
+            _armed_mtime = mtime
+            _armed = _read_armed()
+    return _armed
+
+
+def arm(route, seconds):
+    # profiles requests to route for the next seconds, 0 disarms it
+    global _armed_checked
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    now = time.time()
+    routes = {r: until for r, until in _read_armed().items() if until > now}
+    if seconds > 0:
+        routes[route] = now + seconds
+    else:
+        routes.pop(route, None)
+    tmp = _armed_path() + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(routes, f)
+    os.replace(tmp, _armed_path())
+    _armed_checked = 0.0
+    return routes
+
+
+def wanted(route):
+    routes = armed()
+    if not routes:
+        return False
+    until = routes.get(route, routes.get("*"))
+    return until is not None and until > time.time()
+
+
+def start():
+    # returns None if another request in this process is being profiled
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        return None
+    metrics.recording.statements = []
+    return profiler
+
+
+def finish(profiler, request, status, elapsed):
+    # writes the profile, returns its name
+    profiler.disable()
+    statements = metrics.recording.statements
+    metrics.recording.statements = None
+    route = request.url_rule.rule if request.url_rule else request.path
+    name = "%s-%06d-%s-%dms" % (
+        time.strftime("%Y%m%d-%H%M%S"),
+        int(time.time() * 1e6) % 1000000,
+        re.sub(r"[^A-Za-z0-9]+", "_", route).strip("_"),
+        elapsed * 1000,
+    )
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path = os.path.join(PROFILE_DIR, name)
+    profiler.dump_stats(path + ".prof")
+    with open(path + ".txt", "w") as f:
+        f.write(
+            "%s %s %s %.1fms\n\n"
+            % (request.method, request.path, status, elapsed * 1000)
+        )
+        f.write(
+            "%d SQL statements, %.1fms\n"
+            % (len(statements), sum(s[1] for s in statements) * 1000)
+        )
+        for sql, seconds in sorted(statements, key=lambda s: -s[1]):
+            f.write("%9.2fms  %s\n" % (seconds * 1000, " ".join(sql.split())))
+        f.write("\n")
+        stats = pstats.Stats(profiler, stream=f)
+        stats.sort_stats("cumulative").print_stats(TOP_FUNCTIONS)
+    _rotate()
+    return name
+
+
+def _rotate():
+    names = sorted(
+        set(os.path.splitext(f)[0] for f in os.listdir(PROFILE_DIR) if f[0].isdigit())
+    )
+    for name in names[:-MAX_PROFILES]:
+        for ext in (".prof", ".txt"):
+            try:
+                os.remove(os.path.join(PROFILE_DIR, name + ext))
+            except FileNotFoundError:
+                pass
+
+
+def profiles():
+    # newest first
+    try:
+        files = os.listdir(PROFILE_DIR)
+    except FileNotFoundError:
+        return []
+    return sorted((f for f in files if f[0].isdigit()), reverse=True)
@@ -0,0 +1,49 @@
+import time
+import threading
+import collections
+
+# Token buckets keyed by e.g. ("auth-ip", address): each holds up to capacity
+# tokens, refilled evenly over period seconds, and every attempt takes one.
+# Buckets are per worker process, so with several workers a client gets up to
+# that many times the limit. Behind a load balancer set TRUSTED_PROXIES, or every
+# client shares the balancer's address and the per-address limits apply to the
+# whole site.
+
+MAX_BUCKETS = 65536
+AUTH_IP = (20, 60)  # 20 attempts, refilled over a minute
+AUTH_EMAIL = (5, 300)
+SIGNUP_IP = (5, 3600)
+SIGNUP_EMAIL = (3, 3600)
+
+_buckets = collections.OrderedDict()  # key -> (tokens, last refill)
+_lock = threading.Lock()
+
+
+def take(key, limit):
+    # returns 0 if the attempt is allowed, otherwise the seconds until it is
+    capacity, period = limit
+    rate = capacity / period
+    now = time.monotonic()
+    with _lock:
+        tokens, last = _buckets.pop(key, (capacity, now))
+        tokens = min(capacity, tokens + (now - last) * rate)
+        if tokens >= 1:
+            wait = 0
+            tokens -= 1
+        else:
+            wait = (1 - tokens) / rate
+        _buckets[key] = (tokens, now)
+        while len(_buckets) > MAX_BUCKETS:
+            _buckets.popitem(last=False)
+    return wait
+
+
+def limited(kind, address, email):
+    # takes from the address's and the email's bucket for kind ("auth" or
+    # "signup"), returns 0 or the seconds to wait
+    limits = {"auth": (AUTH_IP, AUTH_EMAIL), "signup": (SIGNUP_IP, SIGNUP_EMAIL)}
+    ip_limit, email_limit = limits[kind]
+    wait = take((kind + "-ip", address), ip_limit)
+    if wait == 0 and email:
+        wait = take((kind + "-email", email.strip().lower()), email_limit)
+    return wait
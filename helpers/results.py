@@ -0,0 +1,165 @@
+import os
+import stat
+import shutil
+import hashlib
+import secrets
+import tarfile
+import zipfile
+import tempfile
+from werkzeug.utils import secure_filename
+from helpers import storage
+
+# The backend sends an experiment's outputs either as multipart fields (one per
+# output, or an `archive` field holding a tar or zip) or as a raw tar / zip
+# request body, which is extracted as it arrives. A SHA256SUMS file in the
+# archive, or a `manifest` field, lists `<sha256>  <name>` lines that every
+# listed output must match. Outputs are written and fsynced in a staging folder,
+# saved to the storage backend (see helpers/storage.py) once all of them are
+# verified, and only moved into place once the upload holds the lease.
+
+CHUNK_SIZE = 1024 * 1024
+MANIFEST_NAME = "SHA256SUMS"
+TAR_TYPES = [
+    "application/x-tar",
+    "application/gzip",
+    "application/x-gzip",
+    "application/x-gtar",
+    "application/x-bzip2",
+    "application/x-xz",
+]
+ZIP_TYPES = ["application/zip", "application/x-zip-compressed"]
+
+
+def staging_folder(folder):
+    # hidden, so neither the listing nor reconcile-outputs sees it
+    parent, name = os.path.split(folder)
+    return os.path.join(parent, ".partial-%s-%s" % (name, secrets.token_hex(4)))
+
+
+def _write(stage, name, stream):
+    sha = hashlib.sha256()
+    with open(os.path.join(stage, name), "wb") as f:
+        while True:
+            chunk = stream.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            sha.update(chunk)
+            f.write(chunk)
+        f.flush()
+        os.fsync(f.fileno())
+    return sha.hexdigest()
+
+
+def _extract_tar(stream, stage, received):
+    manifest = None
+    with tarfile.open(fileobj=stream, mode="r|*") as tar:
+        for member in tar:
+            # directories, links and devices are skipped
+            if not member.isfile():
+                continue
+            if os.path.basename(member.name) == MANIFEST_NAME:
+                manifest = tar.extractfile(member).read().decode()
+                continue
+            name = secure_filename(member.name)
+            if name:
+                received[name] = _write(stage, name, tar.extractfile(member))
+    return manifest
+
+
+def _extract_zip(fileobj, stage, received):
+    manifest = None
+    with zipfile.ZipFile(fileobj) as archive:
+        for info in archive.infolist():
+            if info.is_dir() or stat.S_ISLNK(info.external_attr >> 16):
+                continue
+            if os.path.basename(info.filename) == MANIFEST_NAME:
+                manifest = archive.read(info).decode()
+                continue
+            name = secure_filename(info.filename)
+            if name:
+                with archive.open(info) as f:
+                    received[name] = _write(stage, name, f)
+    return manifest
+
+
+def _extract(stream, filename, stage, received):
+    if filename.endswith(".zip"):
+        return _extract_zip(stream, stage, received)
+    return _extract_tar(stream, stage, received)
+
+
+def receive(request, stage):
+    # writes the outputs in request to stage, returns ({name: sha256}, manifest
+    # text or None)
+    os.makedirs(stage)
+    received = {}
+    if request.mimetype in TAR_TYPES:
+        return received, _extract_tar(request.stream, stage, received)
+    if request.mimetype in ZIP_TYPES:
+        # zip's index is at the end, so the body is spooled to disk first
+        with tempfile.TemporaryFile(dir=stage) as spool:
+            shutil.copyfileobj(request.stream, spool, CHUNK_SIZE)
+            spool.seek(0)
+            return received, _extract_zip(spool, stage, received)
+    manifest = request.form.get("manifest")
+    for field, file in request.files.items(multi=True):
+        if field == "manifest":
+            manifest = file.read().decode()
+        elif field == "archive":
+            found = _extract(file.stream, file.filename, stage, received)
+            manifest = found if found is not None else manifest
+        else:
+            name = secure_filename(file.filename)
+            if name:
+                received[name] = _write(stage, name, file.stream)
+    return received, manifest
+
+
+def verify(received, manifest):
+    # returns an error message or None
+    if manifest is None:
+        return None
+    for line in manifest.splitlines():
+        if not line.strip():
+            continue
+        digest, _, name = line.strip().partition(" ")
+        # sha256sum marks binary mode with a leading *
+        name = secure_filename(name.strip().lstrip("*"))
+        if name not in received:
+            return 'The output "%s" is missing' % (name,)
+        if received[name] != digest.lower():
+            return 'The output "%s" does not match its checksum' % (name,)
+    return None
+
+
+def upload(stage, received):
+    # saves the verified outputs to the store, still under the hidden stage,
+    # returns {name: (size, mtime)}. On local storage they're already there
+    store = storage.backend()
+    found = {}
+    for name in received:
+        path = os.path.join(stage, name)
+        if not store.local:
+            store.save(path, path)
+        found[name] = store.stat(path)
+    return found
+
+
+def publish(stage, folder, received):
+    # moves the uploaded outputs into folder, returns their paths. Only call
+    # once the experiment's lease is won, it replaces what folder holds
+    store = storage.backend()
+    store.makedirs(folder)
+    published = []
+    for name in received:
+        dest = os.path.join(folder, name)
+        store.move(os.path.join(stage, name), dest)
+        published.append(dest)
+    store.sync(folder)
+    discard(stage)
+    return published
+
+
+def discard(stage):
+    storage.backend().delete(stage)
+    shutil.rmtree(stage, ignore_errors=True)
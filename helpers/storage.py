@@ -0,0 +1,343 @@
+import io
+import os
+import stat
+import shutil
+import threading
+
+# Inputs, blobs and outputs are kept either on the local filesystem under
+# UPLOAD_FOLDER (the default) or, with STORAGE_BACKEND=s3, in an S3 bucket
+# (or anything that speaks its API, e.g. MinIO through S3_ENDPOINT_URL).
+# Either way they're named by their path under UPLOAD_FOLDER, which is what the
+# database stores, and the S3 key is that path relative to UPLOAD_FOLDER.
+# UPLOAD_FOLDER is still needed with S3: uploads and results are received and
+# hashed there before they're saved to the bucket. A bucket has no links, so an
+# input linked to its blob is an empty object whose metadata names the blob's
+# key, which stat, open, stream and walk follow.
+
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "local")
+S3_BUCKET = os.environ.get("S3_BUCKET")
+S3_ENDPOINT_URL = os.environ.get("S3_ENDPOINT_URL")
+S3_PREFIX = os.environ.get("S3_PREFIX", "")
+# objects above the threshold are uploaded and copied in parts of
+# S3_PART_SIZE, S3_CONCURRENCY at a time
+S3_MULTIPART_THRESHOLD = int(os.environ.get("S3_MULTIPART_THRESHOLD", 16 * 1024 * 1024))
+S3_PART_SIZE = int(os.environ.get("S3_PART_SIZE", 16 * 1024 * 1024))
+S3_CONCURRENCY = int(os.environ.get("S3_CONCURRENCY", "8"))
+CHUNK_SIZE = 1024 * 1024
+
+_backend = None
+_backend_pid = None
+_backend_lock = threading.Lock()
+
+
+def backend():
+    global _backend, _backend_pid
+    with _backend_lock:
+        # boto3's connections don't survive a fork of this process
+        if _backend is None or _backend_pid != os.getpid():
+            if STORAGE_BACKEND == "s3":
+                _backend = S3Storage(S3_BUCKET, S3_ENDPOINT_URL, S3_PREFIX)
+            else:
+                _backend = LocalStorage()
+            _backend_pid = os.getpid()
+    return _backend
+
+
+def _fsync_dir(folder):
+    fd = os.open(folder, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _unlinked_size(path):
+    # a hardlinked input only frees its blocks with the last link
+    st = os.lstat(path)
+    return st.st_size if st.st_nlink <= 1 else 0
+
+
+class LocalStorage:
+    local = True
+
+    def save(self, tmp, path):
+        # moves the local file tmp to path
+        os.replace(tmp, path)
+
+    def move(self, src, dest):
+        # renames a stored file
+        os.replace(src, dest)
+
+    def link(self, src, dest):
+        if os.path.lexists(dest):
+            os.remove(dest)
+        try:
+            os.link(src, dest)
+        except OSError:
+            # e.g. the blob area is on another filesystem
+            shutil.copyfile(src, dest)
+
+    def open(self, path):
+        return open(path, "rb")
+
+    def stream(self, path):
+        # a seekable file object that's read lazily, for ranged responses
+        return open(path, "rb")
+
+    def list(self, folder):
+        # the names in folder, [] if there's no such folder
+        try:
+            return os.listdir(folder)
+        except (FileNotFoundError, NotADirectoryError):
+            return []
+
+    def walk(self, folder):
+        # yields (path, size, mtime) for every file under folder, in order
+        for root, dirs, files in os.walk(folder):
+            dirs.sort()
+            for file in sorted(files):
+                path = os.path.join(root, file)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield path, st.st_size, st.st_mtime
+
+    def stat(self, path):
+        # (size, mtime), raises FileNotFoundError
+        st = os.stat(path)
+        if not stat.S_ISREG(st.st_mode):
+            raise FileNotFoundError(path)
+        return st.st_size, st.st_mtime
+
+    def exists(self, path):
+        return os.path.exists(path)
+
+    def delete(self, path):
+        # removes a file or a folder, returns the bytes freed
+        freed = 0
+        try:
+            if os.path.isdir(path) and not os.path.islink(path):
+                for root, dirs, files in os.walk(path):
+                    freed += sum(_unlinked_size(os.path.join(root, f)) for f in files)
+                shutil.rmtree(path)
+            else:
+                freed = _unlinked_size(path)
+                os.remove(path)
+        except FileNotFoundError:
+            pass
+        return freed
+
+    def makedirs(self, folder):
+        os.makedirs(folder, exist_ok=True)
+
+    def sync(self, folder):
+        # makes the files saved to folder durable
+        _fsync_dir(folder)
+
+
+class _S3Reader(io.RawIOBase):
+    # a seekable view of an object that only GETs the range from the current
+    # position on, so a 304 costs nothing and a Range request fetches no more
+    # than it sends
+
+    def __init__(self, client, bucket, key, size):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.size = size
+        self.position = 0
+        self.body = None
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset != self.position:
+            self._drop()
+            self.position = offset
+        return self.position
+
+    def readinto(self, buffer):
+        if self.position >= self.size:
+            return 0
+        if self.body is None:
+            self.body = self.client.get_object(
+                Bucket=self.bucket,
+                Key=self.key,
+                Range="bytes=%d-" % (self.position,),
+            )["Body"]
+        data = self.body.read(len(buffer))
+        buffer[: len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+    def _drop(self):
+        if self.body is not None:
+            self.body.close()
+            self.body = None
+
+    def close(self):
+        self._drop()
+        super().close()
+
+
+class S3Storage:
+    local = False
+
+    def __init__(self, bucket, endpoint_url=None, prefix=""):
+        # optional, only needed with STORAGE_BACKEND=s3
+        import boto3
+        from boto3.s3.transfer import TransferConfig
+
+        if not bucket:
+            raise RuntimeError("STORAGE_BACKEND=s3 needs S3_BUCKET")
+        # credentials and region come from the usual AWS_* variables or files
+        self.client = boto3.session.Session().client("s3", endpoint_url=endpoint_url)
+        self.bucket = bucket
+        self.prefix = prefix.strip("/") + "/" if prefix.strip("/") else ""
+        self.transfer = TransferConfig(
+            multipart_threshold=S3_MULTIPART_THRESHOLD,
+            multipart_chunksize=S3_PART_SIZE,
+            max_concurrency=S3_CONCURRENCY,
+        )
+
+    def key(self, path):
+        relative = os.path.relpath(path, os.environ["UPLOAD_FOLDER"])
+        return self.prefix + ("" if relative == "." else relative)
+
+    def folder_key(self, folder):
+        key = self.key(folder)
+        return key if key == self.prefix else key + "/"
+
+    def path(self, key):
+        return os.path.join(os.environ["UPLOAD_FOLDER"], key[len(self.prefix) :])
+
+    def save(self, tmp, path):
+        self.client.upload_file(tmp, self.bucket, self.key(path), Config=self.transfer)
+        os.remove(tmp)
+
+    def move(self, src, dest):
+        # a server side copy, nothing goes through this process
+        self.client.copy(
+            {"Bucket": self.bucket, "Key": self.key(src)},
+            self.bucket,
+            self.key(dest),
+            Config=self.transfer,
+        )
+        self.client.delete_object(Bucket=self.bucket, Key=self.key(src))
+
+    def link(self, src, dest):
+        size, mtime = self.stat(src)
+        self.client.put_object(
+            Bucket=self.bucket,
+            Key=self.key(dest),
+            Body=b"",
+            Metadata={"blob": self.key(src), "size": str(size)},
+        )
+
+    def _head(self, path):
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=self.key(path))
+        except self.client.exceptions.ClientError as error:
+            if error.response["Error"]["Code"] in ("404", "NoSuchKey"):
+                raise FileNotFoundError(path)
+            raise
+
+    def _resolve(self, path):
+        # (key, size, mtime) of the object holding path's content
+        head = self._head(path)
+        metadata = head.get("Metadata", {})
+        mtime = head["LastModified"].timestamp()
+        if "blob" in metadata:
+            return metadata["blob"], int(metadata["size"]), mtime
+        return self.key(path), head["ContentLength"], mtime
+
+    def open(self, path):
+        # read straight from the response body, nothing is fetched ahead
+        key, size, mtime = self._resolve(path)
+        return io.BufferedReader(
+            _S3Reader(self.client, self.bucket, key, size), CHUNK_SIZE
+        )
+
+    def stream(self, path):
+        return self.open(path)
+
+    def _objects(self, prefix, **kwargs):
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix, **kwargs):
+            yield page
+
+    def list(self, folder):
+        prefix = self.folder_key(folder)
+        names = []
+        for page in self._objects(prefix, Delimiter="/"):
+            names += [
+                p["Prefix"][len(prefix) : -1] for p in page.get("CommonPrefixes", [])
+            ]
+            names += [o["Key"][len(prefix) :] for o in page.get("Contents", [])]
+        return names
+
+    def walk(self, folder):
+        # keys are listed in order, empty ones may be links to a blob
+        for page in self._objects(self.folder_key(folder)):
+            for o in page.get("Contents", []):
+                path = self.path(o["Key"])
+                if o["Size"] == 0:
+                    try:
+                        yield (path,) + self._resolve(path)[1:]
+                    except FileNotFoundError:
+                        pass
+                    continue
+                yield path, o["Size"], o["LastModified"].timestamp()
+
+    def stat(self, path):
+        return self._resolve(path)[1:]
+
+    def exists(self, path):
+        try:
+            self.stat(path)
+            return True
+        except FileNotFoundError:
+            pass
+        for page in self._objects(self.folder_key(path), MaxKeys=1):
+            return page.get("KeyCount", 0) > 0
+        return False
+
+    def delete(self, path):
+        # a link to a blob frees nothing, the blob goes with its last reference
+        try:
+            size = self._head(path)["ContentLength"]
+            self.client.delete_object(Bucket=self.bucket, Key=self.key(path))
+            return size
+        except FileNotFoundError:
+            pass
+        freed = 0
+        for page in self._objects(self.folder_key(path)):
+            objects = page.get("Contents", [])
+            if not objects:
+                continue
+            # a page holds at most 1000 keys, as many as one request can delete
+            self.client.delete_objects(
+                Bucket=self.bucket,
+                Delete={"Objects": [{"Key": o["Key"]} for o in objects], "Quiet": True},
+            )
+            freed += sum(o["Size"] for o in objects)
+        return freed
+
+    def makedirs(self, folder):
+        pass
+
+    def sync(self, folder):
+        # an object is durable once its upload returns
+        pass
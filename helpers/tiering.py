@@ -0,0 +1,145 @@
+import os
+import gzip
+import shutil
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import helpers
+
+# Outputs older than TIER_AFTER_DAYS are gzipped in place to <name>.tiered.gz,
+# on a pool of worker processes, and the catalog row follows the file. The
+# workers only write the compressed copy, this process swaps it in. Users
+# still see and fetch <name>: static_file sends the compressed bytes with
+# Content-Encoding: gzip when the client accepts it and decompresses on the
+# fly otherwise. Formats that are already compressed are left alone. Only
+# outputs on the local storage backend are tiered.
+
+SUFFIX = ".tiered.gz"
+TIER_AFTER_DAYS = int(os.environ.get("TIER_AFTER_DAYS", "30"))
+TIER_WORKERS = int(os.environ.get("TIER_WORKERS", os.cpu_count() or 1))
+CHUNK_SIZE = 1024 * 1024
+COMPRESS_LEVEL = 6
+
+select_candidates = "SELECT path FROM outputs WHERE mtime < ?"
+update_output = "UPDATE outputs SET path = ?, size = ? WHERE path = ?"
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def executor():
+    global _pool, _pool_pid
+    with _pool_lock:
+        # worker processes don't survive a fork of this one
+        if _pool is None or _pool_pid != os.getpid():
+            try:
+                # a fork of the multi-threaded server could inherit a lock
+                # another thread holds, e.g. the metrics', and hang on it
+                _pool = ProcessPoolExecutor(
+                    TIER_WORKERS, mp_context=multiprocessing.get_context("spawn")
+                )
+            except TypeError:
+                # python 3.6 always forks, compress() takes no locks
+                _pool = ProcessPoolExecutor(TIER_WORKERS)
+            _pool_pid = os.getpid()
+    return _pool
+
+
+def candidates(db, cutoff):
+    # outputs last modified before cutoff that are worth compressing
+    return [
+        row[0]
+        for row in db.execute(select_candidates, (cutoff,)).fetchall()
+        if not row[0].endswith(SUFFIX)
+        and not row[0].endswith(helpers.COMPRESSED_EXTENSIONS)
+    ]
+
+
+def compress(path):
+    # runs in a worker process, writes a compressed copy of path next to it and
+    # returns (copy, its size, path's version) or None if it's not worth it
+    folder, name = os.path.split(path)
+    # hidden, so the listing doesn't show it while it's written
+    tmp = os.path.join(folder, "." + name + SUFFIX + ".tmp")
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    with open(path, "rb") as src, open(tmp, "wb") as raw:
+        with gzip.GzipFile(
+            filename=name,
+            mode="wb",
+            fileobj=raw,
+            compresslevel=COMPRESS_LEVEL,
+            mtime=int(st.st_mtime),
+        ) as gz:
+            shutil.copyfileobj(src, gz, CHUNK_SIZE)
+        raw.flush()
+        os.fsync(raw.fileno())
+    size = os.stat(tmp).st_size
+    if size >= st.st_size:
+        os.remove(tmp)
+        return None
+    # keeps the output's age for the reaper
+    os.utime(tmp, ns=(st.st_atime_ns, st.st_mtime_ns))
+    return tmp, size, (st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+def _version(path):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return st.st_ino, st.st_mtime_ns, st.st_size
+
+
+def tier(path):
+    # compresses path on the pool and replaces it with the copy, returns the
+    # bytes freed
+    compressed = executor().submit(compress, path).result()
+    if compressed is None:
+        return 0
+    tmp, size, version = compressed
+    conn, db = helpers.create_conn()
+    try:
+        # holding the write lock, so upload_results can't publish path again
+        # until it's replaced, and isn't replaced if that happened meanwhile
+        db.execute(update_output, (path + SUFFIX, size, path))
+        if _version(path) != version:
+            conn.rollback()
+            os.remove(tmp)
+            return 0
+        os.replace(tmp, path + SUFFIX)
+        os.remove(path)
+        conn.commit()
+    finally:
+        conn.close()
+    return version[2] - size
+
+
+def discard_stale(db, path):
+    # a compressed copy left over from before path was uploaded again
+    if os.path.isfile(path + SUFFIX):
+        os.remove(path + SUFFIX)
+        db.execute("DELETE FROM outputs WHERE path = ?", (path + SUFFIX,))
+
+
+def original_name(name):
+    return name[: -len(SUFFIX)] if name.endswith(SUFFIX) else name
+
+
+def tiered_path(path):
+    # the compressed copy of path if only that exists, otherwise None
+    if not os.path.isfile(path) and os.path.isfile(path + SUFFIX):
+        return path + SUFFIX
+    return None
+
+
+def decompressed(path):
+    with gzip.open(path, "rb") as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
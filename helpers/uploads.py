@@ -0,0 +1,129 @@
+import os
+import re
+import hashlib
+import secrets
+import threading
+import time
+
+CHUNK_SIZE = 1024 * 1024
+# uploads that aren't attached to an experiment within this long are removed
+# by the reaper, see /files/delete/batch
+UPLOAD_TTL_DAYS = int(os.environ.get("UPLOAD_TTL_DAYS", "7"))
+
+# hashes of in-progress uploads, keyed by upload id, so each chunk only hashes
+# its own bytes (rebuilt from the partial file after a restart), with when
+# they were last written
+_hashes = {}
+_locks = {}
+_lock = threading.Lock()
+
+
+def new_id():
+    return secrets.token_hex(16)
+
+
+def upload_lock(upload_id):
+    with _lock:
+        return _locks.setdefault(upload_id, threading.Lock())
+
+
+def part_path(uid, upload_id):
+    return os.path.join(
+        os.environ["UPLOAD_FOLDER"], str(uid), "uploads", upload_id + ".part"
+    )
+
+
+def empty(path):
+    # a zero-byte upload is complete as soon as it's created, returns its sha256
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    open(path, "wb").close()
+    return hashlib.sha256().hexdigest()
+
+
+def parse_content_range(header):
+    # "bytes <start>-<end>/<total>", returns (start, end, total) or None
+    match = re.match(r"^bytes (\d+)-(\d+)/(\d+|\*)$", header or "")
+    if not match:
+        return None
+    total = None if match.group(3) == "*" else int(match.group(3))
+    return int(match.group(1)), int(match.group(2)), total
+
+
+def _hash_to(path, offset):
+    sha = hashlib.sha256()
+    if offset == 0:
+        return sha
+    remaining = offset
+    with open(path, "rb") as f:
+        while remaining > 0:
+            chunk = f.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            sha.update(chunk)
+            remaining -= len(chunk)
+    return sha
+
+
+def write_chunk(path, upload_id, stream, start, limit):
+    # appends stream to the partial file at start, refusing to write past
+    # limit, returns an error message or None. Whatever was written before a
+    # dropped connection is kept so the client can resume from offset().
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    _prune()
+    cached = _hashes.get(upload_id)
+    if cached is not None and cached[0] == start:
+        sha = cached[1]
+    else:
+        sha = _hash_to(path, start)
+    written = 0
+    error = None
+    with open(path, "r+b" if os.path.exists(path) else "wb") as f:
+        f.seek(start)
+        # drop bytes past the last recorded offset left by an interrupted write
+        f.truncate()
+        try:
+            while True:
+                chunk = stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                if start + written + len(chunk) > limit:
+                    error = "upload exceeds its declared size"
+                    break
+                f.write(chunk)
+                sha.update(chunk)
+                written += len(chunk)
+        finally:
+            f.flush()
+            os.fsync(f.fileno())
+            _hashes[upload_id] = (start + written, sha, time.time())
+    return error
+
+
+def _prune():
+    # drops the state of uploads abandoned in this process, the reaper removes
+    # their rows and files
+    cutoff = time.time() - UPLOAD_TTL_DAYS * 86400
+    for upload_id in [u for u, e in list(_hashes.items()) if e[2] < cutoff]:
+        forget(upload_id)
+
+
+def offset(upload_id, default):
+    return _hashes.get(upload_id, (default,))[0]
+
+
+def checksum(upload_id):
+    return _hashes[upload_id][1].hexdigest()
+
+
+def forget(upload_id):
+    _hashes.pop(upload_id, None)
+    with _lock:
+        _locks.pop(upload_id, None)
+
+
+def discard(path, upload_id):
+    forget(upload_id)
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,51 @@
+# Each user's input files and their bytes are counted in the usage table, kept
+# up to date in the same transaction that adds or removes files rows, so quota
+# checks never count files. A user's quota is the largest value of each limit
+# over their groups, limits their groups don't set fall back to DEFAULT_LIMITS.
+
+DEFAULT_LIMITS = {"max_files": 50, "max_bytes": None}
+
+select_usage = "SELECT files, bytes FROM usage WHERE uid = ?"
+select_limits = "SELECT name, MAX(CAST(value AS INTEGER)) FROM limits WHERE name IN ('max_files', 'max_bytes') AND gid IN (SELECT gid FROM user_groups WHERE uid = ?) GROUP BY name"
+
+
+def add(db, uid, files, size):
+    # negative counts release quota
+    db.execute("INSERT OR IGNORE INTO usage (uid) VALUES (?)", (uid,))
+    db.execute(
+        "UPDATE usage SET files = files + ?, bytes = bytes + ? WHERE uid = ?",
+        (files, size, uid),
+    )
+
+
+def current(db, uid):
+    row = db.execute(select_usage, (uid,)).fetchone()
+    return row if row is not None else (0, 0)
+
+
+def limits(db, uid):
+    user_limits = dict(DEFAULT_LIMITS)
+    user_limits.update(db.execute(select_limits, (uid,)).fetchall())
+    return user_limits
+
+
+def check(db, uid, files, size):
+    # returns an error message if files more files totalling size bytes don't
+    # fit in the user's quota
+    used_files, used_bytes = current(db, uid)
+    user_limits = limits(db, uid)
+    if user_limits["max_files"] is not None:
+        remaining = max(user_limits["max_files"] - used_files, 0)
+        if files > remaining:
+            return (
+                "The %d files you tried to upload exceed the %d remaining files you have left in your quota"
+                % (files, remaining)
+            )
+    if user_limits["max_bytes"] is not None:
+        remaining = max(user_limits["max_bytes"] - used_bytes, 0)
+        if size > remaining:
+            return (
+                "The %d bytes you tried to upload exceed the %d remaining bytes you have left in your quota"
+                % (size, remaining)
+            )
+    return None
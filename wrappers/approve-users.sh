@@ -2,19 +2,27 @@
 
 set -euo pipefail
 
-for user in $(curl -s "http://localhost:5000/users/list?awaiting_approval=1" | jq -c ".[]"); do
-    email=$(echo $user | jq '.email')
-    uid=$(echo $user | jq '.id')
-    settings=$(echo $user | jq -r '.settings|to_entries|map("\(.key)=\(.value|tostring)")|.[]')
-    echo "A new user, ${email}, has requested approval"
-    echo $settings
-    read -p "Do you want to approve? " -n 1 -r
-    echo # (optional) move to a new line
-    if [[ $REPLY =~ ^[Yy]$ ]]; then
-        curl -s "http://localhost:5000/users/approve/${uid}" > /dev/null
-        echo "Approved user ${email}"
-    else
-        curl -s "http://localhost:5000/users/deny/${uid}" > /dev/null
-        echo "Denied user ${email}"
+cursor=""
+while true; do
+    page=$(curl -s -H "X-Local-Token: ${LOCAL_TOKEN:-}" "http://localhost:5000/users/list?awaiting_approval=1&cursor=${cursor}")
+    for user in $(echo "$page" | jq -c ".users[]"); do
+        email=$(echo $user | jq '.email')
+        uid=$(echo $user | jq '.id')
+        settings=$(echo $user | jq -r '.settings|to_entries|map("\(.key)=\(.value|tostring)")|.[]')
+        echo "A new user, ${email}, has requested approval"
+        echo $settings
+        read -p "Do you want to approve? " -n 1 -r
+        echo # (optional) move to a new line
+        if [[ $REPLY =~ ^[Yy]$ ]]; then
+            curl -s -H "X-Local-Token: ${LOCAL_TOKEN:-}" "http://localhost:5000/users/approve/${uid}" > /dev/null
+            echo "Approved user ${email}"
+        else
+            curl -s -H "X-Local-Token: ${LOCAL_TOKEN:-}" "http://localhost:5000/users/deny/${uid}" > /dev/null
+            echo "Denied user ${email}"
+        fi
+    done
+    cursor=$(echo "$page" | jq -r '.next // empty')
+    if [ -z "$cursor" ]; then
+        break
     fi
 done
@@ -2,11 +2,27 @@
 
 set -euo pipefail
 
-if [ $# -ne 1 ]; then
-    echo "Usage: $0 <retention-in-days>"
+if [ $# -lt 1 ] || [ $# -gt 2 ]; then
+    echo "Usage: $0 <retention-in-days> [timeout-in-seconds]"
     exit 1
 fi
+timeout=${2:-3600}
 
-for f in $(curl -s "http://localhost:5000/files/old?days=$1" | jq -r ".[]"); do
-    curl -X POST -d "path=$f" "http://localhost:5000/files/delete"
+job=$(curl -s -H "X-Local-Token: ${LOCAL_TOKEN:-}" -X POST -d "days=$1" "http://localhost:5000/files/delete/batch" | jq -r ".job")
+deadline=$((SECONDS + timeout))
+while true; do
+    status=$(curl -s -H "X-Local-Token: ${LOCAL_TOKEN:-}" "http://localhost:5000/jobs/$job")
+    if [ "$(echo "$status" | jq -r ".finished")" != "null" ]; then
+        break
+    fi
+    if [ $SECONDS -ge $deadline ]; then
+        echo "job $job still running after ${timeout}s"
+        exit 1
+    fi
+    sleep 1
 done
+echo "$status" | jq -r '"deleted \(.done) of \(.total) paths, freed \(.bytes) bytes, \(.errors) errors"'
+if [ "$(echo "$status" | jq -r ".failed")" = "true" ]; then
+    echo "job $job failed before finishing"
+    exit 1
+fi
@@ -0,0 +1,28 @@
+#!/bin/bash
+
+set -euo pipefail
+
+if [ $# -gt 2 ]; then
+    echo "Usage: $0 [<age-in-days>] [timeout-in-seconds]"
+    exit 1
+fi
+timeout=${2:-3600}
+
+job=$(curl -s -H "X-Local-Token: ${LOCAL_TOKEN:-}" -X POST -d "days=${1:-}" "http://localhost:5000/files/tier" | jq -r ".job")
+deadline=$((SECONDS + timeout))
+while true; do
+    status=$(curl -s -H "X-Local-Token: ${LOCAL_TOKEN:-}" "http://localhost:5000/jobs/$job")
+    if [ "$(echo "$status" | jq -r ".finished")" != "null" ]; then
+        break
+    fi
+    if [ $SECONDS -ge $deadline ]; then
+        echo "job $job still running after ${timeout}s"
+        exit 1
+    fi
+    sleep 1
+done
+echo "$status" | jq -r '"compressed \(.done) of \(.total) outputs, reclaimed \(.bytes) bytes, \(.errors) errors"'
+if [ "$(echo "$status" | jq -r ".failed")" = "true" ]; then
+    echo "job $job failed before finishing"
+    exit 1
+fi